@@ -66,13 +66,124 @@
 # - update to support Python 3. Tests run OK in Python 2.7 and 3.4
 # - not tested in earlier versions, but definitely won't work for
 # Python earlier than 2.3
+#
+# Version 2.2.0
+# - patterns without tags are matched using a lazily built DFA, with a
+# bounded cache of states (set Pattern.mode to 'nfa' to walk the node
+# graph instead)
+# - patterns with tags use a tagged DFA, where tag positions are kept
+# in registers updated by operations on each transition
+# - Pattern.compile('dfa') builds and minimizes the whole DFA in advance
+# - when walking the node graph, all start positions share one list of
+# threads, and a thread reaching a node already reached by a thread of
+# higher priority is dropped - this also makes RE11 run in linear time
+# - while no partial match is live, skip to the next character which
+# can start a match
+# - for large sets of regexps, an Aho-Corasick automaton over literals
+# required by each regexp finds which regexps can match a text, and
+# text too far from any literal is skipped
+# - fix merging of character maps, where a map shared by two links
+# lists was changed for both
+# - the namespace of a thread is an immutable pair of loop counters,
+# kept by slot, and tags, kept as a linked list, so it is shared by
+# all the threads reached from it instead of being copied for each
+# - a DFA partial in the same state as one with an earlier start is
+# dropped, so partials no longer build up while a match is pending
+# - add Pattern.finditer, findall and split, which search the whole of
+# a text with one Matcher, using the new Matcher.reset
+# - add StreamMatcher and Pattern.stream to find every match in a
+# stream of chunks
+# - bytes regexps match bytes, bytearray and memoryview text, with
+# each byte matched as an int, and a full DFA row for each of the 256
+# bytes - [:class:] in a bytes regexp matches ASCII bytes only
+# - add Pattern.match_many, which uses numpy (if installed) to step a
+# batch of texts through the full DFA together
+# - add Pattern.search_parallel, which splits a text (or a file) into
+# segments searched by a pool of processes, and joins their matches
+# into those of a sequential search
+# - add Pattern.dump and Pattern.load, which save a pattern in a
+# compact versioned format and make it again without compiling the
+# regexps, and pickle patterns the same way
+# - keep the parse tree and required literals of each regexp text in
+# process-wide least recently used caches, scan_cache and compile_cache
+# - addRegExp returns a handle, and Pattern.removeRegExp removes the
+# regexp, changing the prefilter and keeping the cached sub-patterns
+# which do not use it - Pattern.batch groups changes so the start
+# links are made again once
+# - character nodes keep sorted intervals of characters, found by
+# bisection, instead of a dict entry for each character, so a range
+# such as [\x00-\uffff] is one interval, and character maps are merged
+# by intervals - the [:class:] functions look up Latin-1 characters in
+# a table of bits
+# - add Pattern.getAlphabet, which splits the characters into classes
+# treated the same by every character node - the lazy DFA keeps a
+# transition for each class instead of each character seen, and
+# Alphabet.getIntervals shows the class of each interval
+# - add Pattern.search_any, and Matcher.earliest, which return the
+# first match reached instead of waiting for the leftmost longest match
+# - add Pattern.prefixmatch and Pattern.fullmatch, which only follow
+# threads from the start of the text (Matcher.anchored), and stop
+# reading the text when none are left
+# - add Pattern.search_reverse, which finds the end of the first match
+# with a forward DFA pass that keeps no start positions, then its start
+# by a reverse pass over the reversed regexps (Pattern.getReverse), and
+# only follows the match from that start to find its tags
+# - threads in a loop whose body is one character are kept by the
+# Matcher in a CountingSet of the positions where they entered the
+# loop, so a step costs the same for any bounds - a pattern without
+# tags and with such a loop counting COUNTING_MINIMUM or more characters
+# (Pattern.isCounted) walks the node graph once its lazy DFA overflows
+# and it has no BitNFA
+# - add BitNFA, which keeps the character positions of threads as the
+# bits of an int, for patterns without tags and with at most
+# BITS_MAX_POSITIONS positions - a lazy DFA whose cache overflows is
+# replaced by the BitNFA, in the Matcher and the Pattern, and
+# Pattern.compile('bits') uses it from the start
+# - the nodes reached from each node through option, tag and loop exit
+# nodes are found once for the graph (Pattern.getClosures), with the
+# counters and tags changed on the way, so walking the graph goes
+# straight to the character, match and transition nodes
+# - add Pattern.to_python, which writes the full DFA and the loop of
+# the Matcher over it as the source of a Python module, and
+# Pattern.compile_codegen, which runs that source and returns a
+# function like match()
+# - replace Matcher.debug, which formatted a string for each character,
+# by Matcher.trace (given by Pattern.trace), a Trace counting the
+# characters, node expansions, namespace copies, peak live partials,
+# matches considered and partials pruned, and passing CharEvent,
+# MatchEvent and PruneEvent records to an optional callback - without
+# a Trace, the Matcher only tests for one on each call adding text
+
+__version__ = '2.2'
 
-__version__ = '2.1'
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import mmap
+import os
+import pickle
+import re
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    # only needed by Pattern.match_many
+    numpy = None
 
 TYPE_MATCH = 0
 TYPE_CONTROL = 1
 TYPE_TRANSITION = 2
 TYPE_CHARACTER = 3
+# a set of threads in a counted loop, only found in Matcher partials
+TYPE_COUNTING = 4
+
+# the namespace of a new thread, with no loop counters and no tags
+_NONAMESPACE = ((), None)
 
 class MatchObject:
 
@@ -94,27 +205,112 @@ class MatchObject:
     def value(self):
         return self._value
 
+# Tracing
+#
+# A Trace given to a Matcher (or to a Pattern, which gives it to the
+# Matchers it makes) counts the work done, and passes a record of each
+# event to its callback, if it has one.  A Matcher without a Trace
+# only tests for one on each call which adds text, and for each match
+# it considers, so tracing costs nothing when it is not used.  With a
+# Trace, the text is added one character at a time.  Node expansions
+# and namespace copies are only made, and counted, when the node graph
+# is walked.
+
+CharEvent = collections.namedtuple('CharEvent', 'pos ch partials')
+MatchEvent = collections.namedtuple('MatchEvent',
+                                        'start end value chosen')
+PruneEvent = collections.namedtuple('PruneEvent', 'pos count')
+
+class Trace:
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        # characters added, nodes expanded and namespaces made while
+        # walking the graph, most partials live after a character,
+        # matches given to addMatch, and partials dropped because they
+        # start after a match
+        self.chars = 0
+        self.expansions = 0
+        self.copies = 0
+        self.peak = 0
+        self.matches = 0
+        self.pruned = 0
+
+    def getCounters(self):
+        return {
+            'chars': self.chars,
+            'expansions': self.expansions,
+            'copies': self.copies,
+            'peak': self.peak,
+            'matches': self.matches,
+            'pruned': self.pruned,
+        }
+
 class Matcher:
 
     def __init__(self, pattern):
-        self.debug = None
-
-        self.prevch = ''
+        # a Trace, or None
+        self.trace = pattern.trace
+        # if true, return the first match reached, without waiting to
+        # find the leftmost longest match
+        self.earliest = 0
+        # if true, only matches starting at the position the Matcher
+        # was reset to are found
+        self.anchored = 0
+        # threads in a counted loop are kept in a CountingSet, except
+        # where they have tags
+        self.counting = not pattern.tagged
 
+        self.start0 = pattern.start0
         self.start = pattern.start
-        self.currpos = 0
-        start0 = pattern.start0
-        assert start0.type is TYPE_CONTROL, start0.type
-        namespace = {'tags': ()}
-        self.partials = [(0, [(start0, namespace)])]
+        self.first = pattern.getFirstCharacters()
+        self.prefilter = pattern.getPrefilter()
+        if self.prefilter is not None and self.prefilter.window is None:
+            self.prefilter = None
+        self.skip = self.first is not None or self.prefilter is not None
+        self.dfa = pattern.getDFA()
+        if self.dfa is None:
+            self.closures = pattern.getClosures()
+        else:
+            self.closures = None
+        if self.dfa is not None and self.dfa.tagged:
+            self.noregs = (None,)
+        else:
+            self.noregs = None
+        self.reset()
 
+    def reset(self, pos=0, prevch=''):
+        # Forget any partials and match, and start again as if pos
+        # characters, the last being prevch, had been added - this
+        # lets a Matcher be reused after a match.
+        self.prevch = prevch
+        self.currpos = pos
+        if self.dfa is None:
+            # each partial is a (startpos, node, namespace) thread, in
+            # order of priority
+            if pos == 0:
+                start = self.start0
+            else:
+                start = self.start
+            assert start.type is TYPE_CONTROL, start.type
+            self.partials = [(pos, start, _NONAMESPACE)]
+        else:
+            # each partial is a (startpos, DFAState, registers) triple,
+            # where registers is None unless the DFA is tagged
+            if pos == 0:
+                initial = self.dfa.initial0
+            else:
+                initial = self.dfa.initial
+            self.partials = [(pos, initial, self.noregs)]
         self.match = None
 
     def addMatch(self, startpos, endpos, match, tags):
         index = match.index()
-        if self.debug:
-            self.debug(' addMatch(%d, %d, %r, %d)' % (startpos, endpos,
-                                                            tags, index))
+        if self.trace is not None:
+            self._traceMatch(startpos, endpos, match, index)
         if (
             self.match is None or
             startpos < self.matchleft or (
@@ -132,57 +328,269 @@ class Matcher:
             self.match = match
             self.matchtags = tags
 
+    def _traceMatch(self, startpos, endpos, match, index):
+        trace = self.trace
+        trace.matches += 1
+        if trace.callback is not None:
+            chosen = (
+                self.match is None or
+                startpos < self.matchleft or (
+                    startpos == self.matchleft and (
+                        endpos > self.matchright or (
+                            endpos == self.matchright and
+                            index < self.matchindex
+                        )
+                    )
+                )
+            )
+            trace.callback(MatchEvent(startpos, endpos, match.value(),
+                                                                chosen))
+
     def getMatch(self):
-        tags = self.matchtags + (self.matchright,)
         return MatchObject(self.matchleft, self.matchright,
-                    self.matchtags, self.match.value())
+                    _tagTuple(self.matchtags), self.match.value())
 
-    def addChar(self, ch):
-        if self.debug:
-            self.debug('addChar(%s)\n' % repr(ch))
+    def _addMatchDFA(self, startpos, match, regs, ops):
+        if regs is None:
+            tags = None
+        else:
+            src, count = ops
+            tags = _pushTags(regs[src], self.currpos, count)
+        self.addMatch(startpos, self.currpos, match, tags)
+
+    def _walk(self, ch):
+        # Expand the partials in priority order and return the new
+        # partials - at the end of the text if ch is '', at the end of
+        # a chunk if ch is None, or else for the next character ch. A
+        # node reached with the same iteration counts as a thread of
+        # higher priority (which includes any thread with an earlier
+        # start) can only repeat what that thread does, so it is
+        # dropped. This keeps the work for each character bounded by
+        # the size of the pattern, however many partials are live.
+        currpos = self.currpos
         partials = []
-        for startpos, nodes in self.partials:
+        seen = {}
+        laststart = -1
+        counting = self.counting
+        # the CountingSet of each counted loop, by loop and counters,
+        # and a heap of the exits from them, which are followed in
+        # order of their start positions
+        csets = {}
+        exits = []
+        nexits = 0
+        # namespaces made, counted for a Trace
+        copies = 0
+        closures = self.closures
+        old = self.partials
+        nold = len(old)
+        j = 0
+        while 1:
+            if exits and (j == nold or exits[0][0] < old[j][0]):
+                startpos, order, links, namespace = heapq.heappop(exits)
+                stack = []
+                copies += _pushClosures(stack, closures, links, namespace,
+                                                                currpos)
+            elif j < nold:
+                startpos, node, namespace = old[j]
+                j += 1
+                if node.type is TYPE_COUNTING:
+                    stack = [(node, namespace)]
+                else:
+                    stack = []
+                    copies += _pushClosures(stack, closures, (node,),
+                                                    namespace, currpos)
+            else:
+                break
             if self.match is not None and startpos > self.matchleft:
-                if self.debug:
-                    self.debug('- remaining nodes pruned\n')
                 break
-            if self.debug:
-                self.debug('- startpos = %d' % startpos)
-            i = 0
-            while i < len(nodes):
-                node, namespace = nodes[i]
-                if node.type is TYPE_MATCH:
-                    self.addMatch(startpos, self.currpos, node,
-                                                    namespace['tags'])
-                    del nodes[i]
-                elif node.type is TYPE_CHARACTER:
-                    links = node.getMatchedLinks(ch)
-                    nodes[i:i+1] = [(x, namespace.copy())
-                                                        for x in links]
-                    i += len(links)
+            if startpos != laststart:
+                laststart = startpos
+                tseen = 0
+            while stack:
+                node, namespace = stack.pop()
+                counters = namespace[0]
+                if counters:
+                    counters = _current(counters, currpos)
+                key = (node, counters)
+                if node.type is TYPE_COUNTING:
+                    key = (node.loop, counters)
+                    cset = csets.get(key)
+                    if cset is not None:
+                        # threads entered the loop here with the same
+                        # counts
+                        node.merge(cset)
+                    csets[key] = node
+                    exitpos = node.exitStart(currpos)
+                    if exitpos is None:
+                        continue
+                    links = node.loop.exit.getAllLinks()
+                    if exitpos > startpos:
+                        # follow the exit after any partial which
+                        # starts earlier
+                        heapq.heappush(exits,
+                                    (exitpos, nexits, links, namespace))
+                        nexits += 1
+                        continue
+                elif key in seen:
+                    continue
                 else:
-                    if node.type is TYPE_CONTROL:
-                        links = node.getMatchedLinks(namespace,
-                                                        self.currpos)
+                    seen[key] = 1
+                    if node.type is TYPE_MATCH:
+                        if tseen:
+                            # if we've seen a transition node then we
+                            # ignore the match for now, since an
+                            # earlier transition is another zero-length
+                            # node which may hide a higher priority
+                            # match
+                            partials.append((startpos, node, namespace))
+                        else:
+                            self.addMatch(startpos, currpos, node,
+                                                        namespace[1])
+                        continue
+                    elif node.type is TYPE_CHARACTER:
+                        if ch is None:
+                            partials.append((startpos, node, namespace))
+                        elif ch != '':
+                            for link in node.getMatchedLinks(ch):
+                                partials.append((startpos, link,
+                                                            namespace))
+                        continue
+                    elif node.type is TYPE_CONTROL:
+                        if (
+                            counting and
+                            node.__class__ is IterationLoopNode and
+                            node.getBody()
+                        ):
+                            # the thread enters the counting set
+                            cset = csets.get(key)
+                            if cset is None:
+                                cset = csets[key] = CountingSet(node)
+                            cset.add(currpos, startpos)
+                            if node.lower:
+                                continue
+                            links = node.exit.getAllLinks()
+                        else:
+                            links, namespace = node.getMatchedLinks(
+                                                    namespace, currpos)
+                            copies += 1
                     else:
                         assert node.type is TYPE_TRANSITION
+                        if ch is None:
+                            tseen = 1
+                            partials.append((startpos, node, namespace))
+                            continue
                         links = node.getMatchedLinks(self.prevch, ch)
-                    nodes[i:i+1] = [(x, namespace.copy())
-                                                        for x in links]
-            if nodes:
-                if self.debug:
-                    self.debug(' not exhausted\n')
-                partials.append((startpos, nodes))
-            else:
-                if self.debug:
-                    self.debug(' exhausted\n')
+                copies += _pushClosures(stack, closures, links, namespace,
+                                                                currpos)
+        if csets:
+            for (loop, counters), cset in csets.items():
+                if self.match is not None:
+                    cset.prune(self.matchleft)
+                if ch is None:
+                    live = cset.alive(currpos)
+                else:
+                    live = ch != '' and cset.step(ch, currpos)
+                if live:
+                    partials.append((cset.startpos(), cset,
+                                            (_stale(counters), None)))
+            # the partials of counting sets go in order of start
+            partials.sort(key=lambda partial: partial[0])
+        if self.trace is not None:
+            self.trace.expansions += len(seen) + len(csets)
+            self.trace.copies += copies
+        return partials
+
+    def addChar(self, ch):
+        self.partials = self._walk(ch)
         self.prevch = ch
         self.currpos += 1
-        self.partials = partials
+
+    def _skip(self, text, i):
+        # Called when no partial is live - move to the next position
+        # in text where a match could start, and return its index.
+        j = i
+        if self.prefilter is not None:
+            j = self.prefilter.find(text, j)
+        if self.first is not None:
+            j = self.first.find(text, j)
+        if j > i:
+            self.currpos += j - i
+            self.prevch = text[j - 1]
+        return j
 
     def addText(self, text):
-        for ch in text:
+        return self._addText(text, 0)
+
+    def _addText(self, text, i):
+        # add the characters of text from index i
+        if self.trace is not None:
+            return self._addTextTraced(text, i)
+        return self._addTextUntraced(text, i)
+
+    def _addTextTraced(self, text, i):
+        # add the characters one at a time, counting the work done on
+        # each in the Trace
+        trace = self.trace
+        callback = trace.callback
+        n = len(text)
+        while i < n:
+            pos = self.currpos
+            old = self.partials
+            match = self._addTextUntraced(text[i:i + 1], 0)
+            if self.match is not None:
+                # the partials after a match are dropped as they are
+                # reached
+                pruned = 0
+                for partial in old:
+                    if partial[0] > self.matchleft:
+                        pruned += 1
+                if pruned:
+                    trace.pruned += pruned
+                    if callback is not None:
+                        callback(PruneEvent(pos, pruned))
+            trace.chars += 1
+            npartials = len(self.partials)
+            if npartials > trace.peak:
+                trace.peak = npartials
+            if callback is not None:
+                callback(CharEvent(pos, text[i], npartials))
+            i += 1
+            if match is not None or (self.anchored and not self.partials):
+                return match
+        return None
+
+    def _addTextUntraced(self, text, i):
+        dfa = self.dfa
+        partials = self.partials
+        if (
+            self.skip and self.match is None and
+            self.currpos > 0 and partials and
+            partials[0][0] == self.currpos
+        ):
+            # only threads starting here are live, so skip to where
+            # they may succeed, and start again from there
+            i = self._skip(text, i)
+            if dfa is None:
+                self.partials = [(self.currpos, self.start,
+                                                        _NONAMESPACE)]
+            else:
+                self.partials = [(self.currpos, dfa.initial, self.noregs)]
+        if dfa is not None:
+            if dfa.tagged:
+                return self._addTextTaggedDFA(text, i)
+            elif isinstance(dfa, BitNFA):
+                return self._addTextBits(text, i)
+            elif isinstance(dfa, FullDFA):
+                return self._addTextFullDFA(text, i)
+            return self._addTextDFA(text, i)
+        skip = self.skip
+        n = len(text)
+        while i < n:
+            ch = text[i]
+            i += 1
             self.addChar(ch)
+            if self.match is not None and self.earliest:
+                return self.getMatch()
             if not self.partials:
                 if self.match is not None:
                     return self.getMatch()
@@ -192,106 +600,514 @@ class Matcher:
                 assert self.match is None or \
                             self.partials[0][0] <= self.matchleft, \
                             repr((self.partials, self.matchleft))
-            if self.match is None:
-                namespace = {'tags': ()}
-                self.partials.append(
-                            (self.currpos, [(self.start, namespace)]))
+            if self.anchored:
+                if not self.partials:
+                    # no match can start after the first position
+                    return None
+            elif self.match is None:
+                if not self.partials and skip:
+                    i = self._skip(text, i)
+                self.partials.append((self.currpos, self.start,
+                                                        _NONAMESPACE))
             else:
                 # no point adding another branch as we already know
                 # the match will start left of the current position
                 assert self.currpos > self.matchleft
         return None
 
-    def addChunk(self, text):
-        match = self.addText(text)
-        if match is None:
-            if self.debug:
-                self.debug('zero-length match at end of text\n')
+    def _addTextBits(self, text, i):
+        # Each partial holds the (live, accept, final) bits of a
+        # BitNFA.  A position live in a partial which starts earlier
+        # can only repeat what that partial does, so it is dropped.
+        bits = self.dfa
+        alphabet = bits.alphabet
+        classmap = alphabet.map
+        steps = bits.steps
+        initial = bits.initial
+        anchored = self.anchored
+        skip = self.skip
+        currpos = self.currpos
+        n = len(text)
+        while i < n:
+            ch = text[i]
+            i += 1
+            cls = classmap.get(ch)
+            if cls is None:
+                cls = alphabet.getClass(ch)
+            linear, other = steps[cls]
             partials = []
-            for startpos, nodes in self.partials:
+            owned = 0
+            for startpos, state, regs in self.partials:
                 if self.match is not None and startpos > self.matchleft:
-                    if self.debug:
-                        self.debug('- remaining nodes pruned\n')
                     break
-                if self.debug:
-                    self.debug('- startpos = %d' % startpos)
-                i = 0
-                tseen = 0
-                while i < len(nodes):
-                    node, namespace = nodes[i]
-                    if node.type is TYPE_MATCH:
-                        if tseen:
-                            # if we've seen a transition node then
-                            # we ignore the match for now, since an
-                            # earlier transition is another
-                            # zero-length node which may hide a
-                            # higher priority match
-                            i += 1
-                        else:
-                            self.addMatch(startpos, self.currpos, node,
-                                                    namespace['tags'])
-                            del nodes[i]
-                    elif node.type is TYPE_CONTROL:
-                        links = node.getMatchedLinks(namespace,
-                                                            self.currpos)
-                        nodes[i:i+1] = [(x, namespace.copy())
-                                                        for x in links]
-                    else:
-                        assert node.type in (TYPE_CHARACTER,
-                                                    TYPE_TRANSITION)
-                        if node.type is TYPE_TRANSITION:
-                            tseen = 1
-                        i += 1
-                if nodes:
-                    if self.debug:
-                        self.debug(' not exhausted\n')
-                    partials.append((startpos, nodes))
+                live, accept, final = state
+                if accept:
+                    self.addMatch(startpos, currpos, bits.getMatch(accept),
+                                                                    None)
+                    if self.earliest:
+                        return self.getMatch()
+                nextlive = (live & linear) << 1
+                accept = final = 0
+                live &= ~linear
+                while live:
+                    bit = live & -live
+                    live ^= bit
+                    step = other.get(bit)
+                    if step is not None:
+                        nextlive |= step[0]
+                        accept |= step[1]
+                        final |= step[2]
+                nextlive &= ~owned
+                if nextlive or final:
+                    # bit 0 is any transition, which is not shared
+                    owned |= nextlive & -2
+                    partials.append((startpos, (nextlive, accept, final),
+                                                                    None))
+            currpos += 1
+            self.prevch = ch
+            self.currpos = currpos
+            self.partials = partials
+            if self.match is None and not anchored:
+                if not partials and skip:
+                    i = self._skip(text, i)
+                    currpos = self.currpos
+                partials.append((currpos, initial, None))
+            elif not partials:
+                if self.match is not None:
+                    return self.getMatch()
+                # anchored, and no match can start later
+                return None
+        return None
+
+    def _addTextDFA(self, text, i):
+        dfa = self.dfa
+        alphabet = dfa.alphabet
+        classmap = alphabet.map
+        initial = dfa.initial
+        anchored = self.anchored
+        skip = self.skip
+        currpos = self.currpos
+        flushes = dfa.flushes
+        overflow = 0
+        n = len(text)
+        while i < n:
+            ch = text[i]
+            i += 1
+            cls = classmap.get(ch)
+            if cls is None:
+                cls = alphabet.getClass(ch)
+            partials = []
+            seen = {}
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
+                    break
+                if state.accept is not None:
+                    self.addMatch(startpos, currpos, state.accept, None)
+                    if self.earliest:
+                        return self.getMatch()
+                try:
+                    state = state.next[cls]
+                except KeyError:
+                    state = dfa.step(state, cls)
+                    overflow = dfa.flushes != flushes
+                if state is not None and state not in seen:
+                    # a later start in the same state can only repeat
+                    # the matches of this one, further right
+                    seen[state] = 1
+                    partials.append((startpos, state, None))
+            currpos += 1
+            self.prevch = ch
+            self.currpos = currpos
+            self.partials = partials
+            if self.match is None and not anchored:
+                if not partials and skip:
+                    i = self._skip(text, i)
+                    currpos = self.currpos
+                partials.append((currpos, initial, None))
+            elif not partials:
+                if self.match is not None:
+                    return self.getMatch()
+                # anchored, and no match can start later
+                return None
+            if overflow:
+                # the states are being built faster than they are
+                # reused, so follow the partials with a BitNFA instead
+                if self._switchToBits():
+                    return self._addTextBits(text, i)
+                if self._switchToWalk():
+                    return self._addTextUntraced(text, i)
+                flushes = dfa.flushes
+                overflow = 0
+        return None
+
+    def _switchToBits(self):
+        # Replace the lazy DFA by its BitNFA, if it has one, with the
+        # bits of the threads of each partial's state.
+        bits = self.dfa.getBits()
+        if bits is None:
+            return 0
+        self.dfa = bits
+        self.partials = [(startpos, bits.getState(state), regs)
+                            for startpos, state, regs in self.partials]
+        return 1
+
+    def _switchToWalk(self):
+        # Replace the lazy DFA by walking the node graph, if counting
+        # sets keep the threads of the large counted loops of its
+        # pattern, with the threads of each partial's state.  A thread
+        # back from the body of a loop that reads one character goes
+        # into a CountingSet, entering the loop one character before
+        # each iteration counted.
+        pattern = self.dfa.pattern
+        if not pattern.isCounted():
+            return 0
+        currpos = self.currpos
+        partials = []
+        for startpos, state, regs in self.partials:
+            for node, counters in state.threads:
+                if (
+                    node.__class__ is IterationLoopNode and
+                    node.getBody() and
+                    counters and counters[-1][0] == node.slot
+                ):
+                    cset = CountingSet(node)
+                    cset.add(currpos - counters[-1][1] - 1, startpos)
+                    partials.append((startpos, cset,
+                                                (counters[:-1], None)))
                 else:
-                    if self.debug:
-                        self.debug(' exhausted\n')
+                    partials.append((startpos, node, (counters, None)))
+        self.dfa = None
+        self.closures = pattern.getClosures()
+        self.partials = partials
+        return 1
+
+    def _addTextFullDFA(self, text, i):
+        binary = self.dfa.binary
+        alphabet = self.dfa.alphabet
+        classmap = alphabet.map
+        initial = self.dfa.initial
+        anchored = self.anchored
+        skip = self.skip
+        currpos = self.currpos
+        n = len(text)
+        while i < n:
+            ch = text[i]
+            i += 1
+            if binary:
+                cls = ch
+            else:
+                cls = classmap.get(ch)
+                if cls is None:
+                    cls = alphabet.getClass(ch)
+            partials = []
+            seen = {}
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
+                    break
+                if state.accept is not None:
+                    self.addMatch(startpos, currpos, state.accept, None)
+                    if self.earliest:
+                        return self.getMatch()
+                state = state.row[cls]
+                if state is not None and state not in seen:
+                    seen[state] = 1
+                    partials.append((startpos, state, None))
+            currpos += 1
+            self.prevch = ch
+            self.currpos = currpos
+            self.partials = partials
+            if self.match is None and not anchored:
+                if not partials and skip:
+                    i = self._skip(text, i)
+                    currpos = self.currpos
+                partials.append((currpos, initial, None))
+            elif not partials:
+                if self.match is not None:
+                    return self.getMatch()
+                # anchored, and no match can start later
+                return None
+        return None
+
+    def _addTextTaggedDFA(self, text, i):
+        dfa = self.dfa
+        alphabet = dfa.alphabet
+        classmap = alphabet.map
+        initial = dfa.initial
+        noregs = self.noregs
+        anchored = self.anchored
+        skip = self.skip
+        currpos = self.currpos
+        n = len(text)
+        while i < n:
+            ch = text[i]
+            i += 1
+            cls = classmap.get(ch)
+            if cls is None:
+                cls = alphabet.getClass(ch)
+            partials = []
+            seen = {}
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
+                    break
+                if state.accept is not None:
+                    src, count = state.accepttags
+                    self.addMatch(startpos, currpos, state.accept,
+                                    _pushTags(regs[src], currpos, count))
+                    if self.earliest:
+                        return self.getMatch()
+                try:
+                    step = state.next[cls]
+                except KeyError:
+                    step = dfa.step(state, cls)
+                if step is not None and step[0] not in seen:
+                    state, ops = step
+                    seen[state] = 1
+                    partials.append((startpos, state,
+                                        _getRegs(regs, ops, currpos)))
+            currpos += 1
+            self.prevch = ch
+            self.currpos = currpos
+            self.partials = partials
+            if self.match is None and not anchored:
+                if not partials and skip:
+                    i = self._skip(text, i)
+                    currpos = self.currpos
+                partials.append((currpos, initial, noregs))
+            elif not partials:
+                if self.match is not None:
+                    return self.getMatch()
+                # anchored, and no match can start later
+                return None
+        return None
+
+    def addChunk(self, text):
+        return self._addChunk(text, 0)
+
+    def _addChunk(self, text, i):
+        match = self._addText(text, i)
+        if match is None and isinstance(self.dfa, BitNFA):
+            bits = self.dfa
+            partials = []
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
+                    break
+                live, accept, final = state
+                # a transition may yet give a better match here
+                if accept and accept & -accept == final & -final:
+                    self.addMatch(startpos, self.currpos,
+                                            bits.getMatch(accept), None)
+                if live:
+                    partials.append((startpos, state, regs))
+            self.partials = partials
+            if self.match is not None and (self.earliest or not partials):
+                match = self.getMatch()
+        elif match is None and self.dfa is not None:
+            partials = []
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
+                    break
+                if state.chunkaccept is not None:
+                    self._addMatchDFA(startpos, state.chunkaccept, regs,
+                                                        state.chunktags)
+                if state.chunkalive:
+                    partials.append((startpos, state, regs))
             self.partials = partials
-            if not partials and self.match is not None:
+            if self.match is not None and (self.earliest or not partials):
+                match = self.getMatch()
+        elif match is None:
+            partials = self._walk(None)
+            self.partials = partials
+            if self.match is not None and (self.earliest or not partials):
                 match = self.getMatch()
         return match
 
     def addFinal(self, text):
-        match = self.addText(text)
-        if match is None:
-            if self.debug:
-                self.debug('add $ metacharacter\n')
-            for startpos, nodes in self.partials:
-                if self.match is not None and \
-                            startpos > self.matchleft:
-                    if self.debug:
-                        self.debug('- remaining nodes pruned\n')
+        return self._addFinal(text, 0)
+
+    def _addFinal(self, text, i):
+        match = self._addText(text, i)
+        if match is None and isinstance(self.dfa, BitNFA):
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
                     break
-                if self.debug:
-                    self.debug('- startpos = %d' % startpos)
-                i = 0
-                while i < len(nodes):
-                    node, namespace = nodes[i]
-                    if node.type is TYPE_MATCH:
-                        self.addMatch(startpos, self.currpos, node,
-                                                    namespace['tags'])
-                        del nodes[i]
-                    elif node.type is TYPE_CHARACTER:
-                        i += 1
-                    else:
-                        if node.type is TYPE_CONTROL:
-                            links = node.getMatchedLinks(namespace,
-                                                            self.currpos)
-                        else:
-                            assert node.type is TYPE_TRANSITION
-                            links = node.getMatchedLinks(self.prevch, '')
-                        nodes[i:i+1] = [(x, namespace.copy())
-                                                        for x in links]
-                if self.debug:
-                    self.debug('\n')
+                final = state[2]
+                if final:
+                    self.addMatch(startpos, self.currpos,
+                                        self.dfa.getMatch(final), None)
+            self.partials = None
+            if self.match is not None:
+                match = self.getMatch()
+        elif match is None and self.dfa is not None:
+            for startpos, state, regs in self.partials:
+                if self.match is not None and startpos > self.matchleft:
+                    break
+                final, ops = state.getFinal()
+                if final is not None:
+                    self._addMatchDFA(startpos, final, regs, ops)
+            self.partials = None
+            if self.match is not None:
+                match = self.getMatch()
+        elif match is None:
+            self._walk('')
             self.partials = None
             if self.match is not None:
                 match = self.getMatch()
         return match
 
+# Searching a text in parallel
+#
+# The text is split into segments, and each is searched by a worker
+# process as finditer would search from the start of the segment - the
+# match found from any position is the match at the first later start
+# position that has one, whatever was searched before, so a search
+# from a resume position in the sequential search finds the same match
+# as a worker search from any earlier position, as long as that match
+# starts at or after the resume position.  Where a worker search was
+# left unfinished at the end of its segment, the parent searches on
+# only until no match can start before a position from where the
+# worker results give the search, and takes them up again there.
+
+PARALLEL_SEGMENT_MINIMUM = 1 << 16  # fewest characters for a worker
+PARALLEL_RESCAN_STEP = 1 << 12  # characters the parent reads at a time
+
+_worker_pattern = None
+
+def _initWorker(pattern):
+    global _worker_pattern
+    _worker_pattern = pattern
+
+def _searchSegment(path, source, begin, end, final):
+    # Search the text from begin to end, where source is the text of
+    # the segment, preceded by the character before begin (if any), or
+    # None to read it from the file path.  final is true for the last
+    # segment.  Returns a list of (resume position, start, end, tags,
+    # value) for the matches found, the position from which the search
+    # was left unfinished at the end of the segment, and the earliest
+    # position where a match from there can start.
+    if source is None:
+        f = open(path, 'rb')
+        try:
+            f.seek(max(begin - 1, 0))
+            source = f.read(end - max(begin - 1, 0))
+        finally:
+            f.close()
+    if begin > 0:
+        prevch = source[0]
+        text = source[1:]
+    else:
+        prevch = ''
+        text = source
+    matcher = Matcher(_worker_pattern)
+    chain = []
+    resume = begin
+    while resume <= end:
+        i = resume - begin
+        if i > 0:
+            matcher.reset(resume, text[i - 1])
+        else:
+            matcher.reset(resume, prevch)
+        if final:
+            match = matcher._addFinal(text, i)
+        else:
+            match = matcher._addChunk(text, i)
+        if match is None:
+            break
+        chain.append((resume, match.start(), match.end(), match.tags(),
+                                                        match.value()))
+        resume = match.end()
+        if match.start() == resume:
+            resume += 1
+    if resume > end:
+        earliest = resume
+    elif final:
+        # there are no more matches
+        earliest = end + 1
+    else:
+        earliest = end
+        if matcher.partials:
+            earliest = min(earliest, matcher.partials[0][0])
+        if matcher.match is not None:
+            earliest = min(earliest, matcher.matchleft)
+    return chain, resume, earliest
+
+class StreamMatcher:
+
+    # Find every match in a stream of chunks, with positions in the
+    # whole stream.  After each match, the search starts again where
+    # the match ended (or one character later, for an empty match),
+    # so only the text from the earliest live partial is kept.
+
+    def __init__(self, pattern):
+        self.matcher = Matcher(pattern)
+        # the text held from stream position bufpos
+        self.buffer = ''
+        self.bufpos = 0
+        # where the next search starts, if beyond the text so far
+        self.resume = None
+
+    def addChunk(self, text):
+        # Returns a list of the matches completed by text.
+        return self._addText(text, 0)
+
+    def addFinal(self, text=''):
+        # Returns a list of the remaining matches, after which the
+        # StreamMatcher cannot be used.
+        return self._addText(text, 1)
+
+    def _addText(self, text, final):
+        matcher = self.matcher
+        if not self.buffer:
+            buffer = text
+        elif not text:
+            buffer = self.buffer
+        else:
+            buffer = self.buffer + text
+        bufpos = self.bufpos
+        matches = []
+        end = bufpos + len(buffer)
+        if self.resume is not None:
+            if self.resume > end:
+                return matches
+            matcher.reset(self.resume, buffer[self.resume - bufpos - 1])
+            self.resume = None
+        while 1:
+            i = matcher.currpos - bufpos
+            if final:
+                match = matcher._addFinal(buffer, i)
+            else:
+                match = matcher._addChunk(buffer, i)
+            if match is None:
+                break
+            matches.append(match)
+            pos = match.end()
+            if match.start() == pos:
+                pos += 1
+            if pos > end:
+                self.resume = pos
+                break
+            if pos == 0:
+                matcher.reset()
+            else:
+                matcher.reset(pos, buffer[pos - bufpos - 1])
+        # keep the text from where the earliest partial started, and
+        # the character before, to reset the Matcher there
+        keep = matcher.currpos
+        if self.resume is not None:
+            keep = end
+        else:
+            if matcher.partials:
+                keep = min(keep, matcher.partials[0][0])
+            if matcher.match is not None:
+                keep = min(keep, matcher.matchleft)
+        keep = max(keep - 1, bufpos)
+        buffer = buffer[keep - bufpos:]
+        if not isinstance(buffer, (str, bytes)):
+            # the caller may reuse a bytearray or memoryview
+            buffer = bytes(buffer)
+        self.buffer = buffer
+        self.bufpos = keep
+        return matches
+
 class Match:
 
     type = TYPE_MATCH
@@ -321,11 +1137,16 @@ def addLink(links, node):
         # nodes overall.
         link = links[0]
         if isinstance(link, CharacterMapNode):
-            if isinstance(link, MutableCharacterMap):
+            if isinstance(link, MutableCharacterMap) and \
+                                                link.owner is links:
                 map = link
             else:
-                # replace immutable map with mutable map
+                # replace immutable map with mutable map - a mutable
+                # map may also have been copied here from another
+                # list by MutableCharacterMap.addMap, and must not be
+                # changed for that list too
                 map = MutableCharacterMap()
+                map.owner = links
                 links[0] = map
                 map.addMap(link)
             map.addMap(node)
@@ -373,17 +1194,31 @@ class FunctionNode(LinkedNode):
         else:
             return ()
 
+# The namespace of a thread is a pair (counters, tags), which is never
+# changed, so it can be shared by every thread reached from it.
+# counters is a tuple of (slot, count, lastpos) for each loop the
+# thread is inside, innermost last, and tags is a list of tag positions
+# in reverse order, as nested pairs (pos, rest) ending in None.  A
+# control node returns its links and the namespace they are reached
+# with.
+
 class ControlNode(FunctionNode):
 
     type = TYPE_CONTROL
 
+    def getMatchedLinks(self, namespace, currpos):
+        if self.func(namespace, currpos):
+            return self.getAllLinks(), namespace
+        else:
+            return (), namespace
+
 class TagControlNode(LinkedNode):
 
     type = TYPE_CONTROL
 
     def getMatchedLinks(self, namespace, currpos):
-        namespace['tags'] += (currpos,)
-        return self.getAllLinks()
+        counters, tags = namespace
+        return self.getAllLinks(), (counters, (currpos, tags))
 
 class OptionalNode:
 
@@ -422,26 +1257,30 @@ class OptionalNode:
         return both
 
     def getMatchedLinks(self, namespace, currpos):
-        return self.getAllLinks()
+        return self.getAllLinks(), namespace
 
 class IterationExitNode(LinkedNode):
 
     type = TYPE_CONTROL
 
-    def __init__(self, name, links=None):
-        self.name = name
+    def __init__(self, slot, links=None):
+        self.slot = slot
         LinkedNode.__init__(self, links)
 
     def getMatchedLinks(self, namespace, currpos):
-        del namespace[self.name]
-        return self.getAllLinks()
+        counters, tags = namespace
+        assert counters[-1][0] == self.slot, (counters, self.slot)
+        return self.getAllLinks(), (counters[:-1], tags)
 
 class IterationLoopNode:
 
     type = TYPE_CONTROL
 
-    def __init__(self, name, lower, upper, exit, isgreedy=1):
-        self.name = name
+    # the character nodes of the body, once found by getBody
+    body = None
+
+    def __init__(self, slot, lower, upper, exit, isgreedy=1):
+        self.slot = slot
         self.lower = lower
         self.upper = upper
         self.exit = exit
@@ -468,14 +1307,25 @@ class IterationLoopNode:
         return both
 
     def getMatchedLinks(self, namespace, currpos):
-        try:
-            count, lastpos = namespace[self.name]
-        except KeyError:
+        counters, tags = namespace
+        slot = self.slot
+        if counters and counters[-1][0] == slot:
+            # back from the body of the loop
+            slot, count, lastpos = counters[-1]
+            count += 1
+            outer = counters[:-1]
+        else:
             count = 0
             lastpos = -1
+            outer = counters
+        if self.upper is None and count > self.lower:
+            # with no upper bound, every count past the lower bound
+            # behaves the same, so store one value to let threads
+            # that differ only in their counts be merged
+            counters = outer + ((slot, self.lower, currpos),)
         else:
-            count += 1
-        namespace[self.name] = (count, currpos)
+            counters = outer + ((slot, count, currpos),)
+        namespace = (counters, tags)
         if self.upper is None or count < self.upper:
             if count >= self.lower:
                 if currpos == lastpos:
@@ -496,7 +1346,187 @@ class IterationLoopNode:
         else:
             assert count == self.upper, (count, self.upper)
             links = (self.exit,)
-        return links
+        return links, namespace
+
+    def getBody(self):
+        # Return the character nodes of the body if each iteration reads
+        # one character and comes straight back here, or else ().
+        body = self.body
+        if body is None:
+            body = tuple(self.links)
+            for node in body:
+                if node.type is not TYPE_CHARACTER:
+                    body = ()
+                elif isinstance(node, CharacterMapNode):
+                    for links in node.segments:
+                        if links and (len(links) != 1 or links[0] is not self):
+                            body = ()
+                elif len(node.links) != 1 or node.links[0] is not self:
+                    body = ()
+            self.body = body
+        return body
+
+# Counting sets
+#
+# Threads of different start positions in a loop such as [a-z]{1,500}
+# differ only in their counts, so the Matcher would keep one for each
+# count.  Where the body reads one character, the count of a thread is
+# the number of characters since it entered the loop, so a CountingSet
+# keeps the threads in a loop as the positions at which they entered.
+# Stepping every thread on a character is then a single test of the
+# body.  A thread which entered later and started no later than another
+# which has reached the lower bound can do all that the other can, so
+# only the leftmost start of the threads able to leave the loop is
+# needed, and a step costs the same for any bounds.  Tags depend on the
+# path of each thread, so counting sets are only used without them.
+#
+# The DFAs keep the count of each thread in its state, so a pattern
+# with a loop counting COUNTING_MINIMUM or more characters may need a
+# state for every count.  If the cache of its lazy DFA overflows, and
+# it has no BitNFA, the pattern is matched by walking the node graph
+# instead.
+
+COUNTING_MINIMUM = 32
+
+class CountingSet:
+
+    type = TYPE_COUNTING
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.body = loop.getBody()
+        # (entry position, start position) of threads below the lower
+        # bound in order of entry, with the entries which start before
+        # any later one in waitmin, and those at or above the lower
+        # bound which start before any later one in ready
+        self.waiting = collections.deque()
+        self.waitmin = collections.deque()
+        self.ready = collections.deque()
+        # no thread starts after maxstart
+        self.maxstart = -1
+
+    def add(self, pos, startpos):
+        # add a thread entering the loop at pos, which is at or after
+        # the entry of every thread already in the set
+        entry = (pos, startpos)
+        if startpos > self.maxstart:
+            self.maxstart = startpos
+        if self.loop.lower == 0:
+            ready = self.ready
+            while ready and ready[-1][1] >= startpos:
+                ready.pop()
+            ready.append(entry)
+        else:
+            self.waiting.append(entry)
+            waitmin = self.waitmin
+            while waitmin and waitmin[-1][1] >= startpos:
+                waitmin.pop()
+            waitmin.append(entry)
+
+    def _entries(self):
+        # the threads in order of entry
+        return list(self.ready) + list(self.waiting)
+
+    def _span(self):
+        # the first and last entry positions of the threads, or None
+        if not (self.ready or self.waiting):
+            return None
+        first = (self.ready or self.waiting)[0][0]
+        last = (self.waiting or self.ready)[-1][0]
+        return first, last
+
+    def merge(self, other):
+        # add the threads of other, keeping the threads in order of entry
+        mine = self._span()
+        theirs = other._span()
+        if theirs is None:
+            return
+        if mine is None or mine[1] <= theirs[0]:
+            entries = other._entries()
+        else:
+            if theirs[1] <= mine[0]:
+                # the threads of other entered first
+                entries = self._entries()
+            else:
+                entries = sorted(self._entries() + other._entries())
+                other = CountingSet(self.loop)
+            self.waiting = other.waiting
+            self.waitmin = other.waitmin
+            self.ready = other.ready
+            self.maxstart = other.maxstart
+        for pos, startpos in entries:
+            self.add(pos, startpos)
+
+    def _update(self, currpos):
+        # move threads reaching the lower bound to ready, and drop
+        # those past the upper bound
+        lower = self.loop.lower
+        upper = self.loop.upper
+        waiting = self.waiting
+        waitmin = self.waitmin
+        ready = self.ready
+        while waiting and currpos - waiting[0][0] >= lower:
+            entry = waiting.popleft()
+            if waitmin[0] is entry:
+                waitmin.popleft()
+            while ready and ready[-1][1] >= entry[1]:
+                ready.pop()
+            ready.append(entry)
+        if upper is not None:
+            while ready and currpos - ready[0][0] > upper:
+                ready.popleft()
+
+    def exitStart(self, currpos):
+        # the leftmost start of the threads which can leave the loop
+        # at currpos, or None
+        self._update(currpos)
+        if self.ready:
+            return self.ready[0][1]
+        return None
+
+    def step(self, ch, currpos):
+        # Read ch at currpos, and return true if any thread is left.
+        for node in self.body:
+            if node.getMatchedLinks(ch):
+                self._update(currpos + 1)
+                return self.ready or self.waiting
+        return 0
+
+    def alive(self, currpos):
+        # Return true if any thread can read a character at currpos.
+        upper = self.loop.upper
+        ready = self.ready
+        if upper is not None:
+            while ready and currpos - ready[0][0] >= upper:
+                ready.popleft()
+        return ready or self.waiting
+
+    def prune(self, startpos):
+        # drop the threads starting after startpos
+        if self.maxstart <= startpos:
+            return
+        ready = self.ready
+        while ready and ready[-1][1] > startpos:
+            ready.pop()
+        waiting = collections.deque()
+        waitmin = collections.deque()
+        for entry in self.waiting:
+            if entry[1] <= startpos:
+                waiting.append(entry)
+                while waitmin and waitmin[-1][1] >= entry[1]:
+                    waitmin.pop()
+                waitmin.append(entry)
+        self.waiting = waiting
+        self.waitmin = waitmin
+        self.maxstart = startpos
+
+    def startpos(self):
+        # the leftmost start of the threads
+        if not self.waitmin:
+            return self.ready[0][1]
+        if not self.ready:
+            return self.waitmin[0][1]
+        return min(self.ready[0][1], self.waitmin[0][1])
 
 class TransitionNode(FunctionNode):
 
@@ -525,39 +1555,115 @@ class CharacterNode(FunctionNode):
 def Always(*args):
     return 1
 
+# Each class is a bit in a table of the 256 Latin-1 characters, so
+# most characters are tested with one lookup.  No character outside
+# Latin-1 is a control character.
+
+_ALNUM = 0x001
+_ALPHA = 0x002
+_CNTRL = 0x004
+_DIGIT = 0x008
+_GRAPH = 0x010
+_LOWER = 0x020
+_PRINT = 0x040
+_PUNCT = 0x080
+_SPACE = 0x100
+_UPPER = 0x200
+_XDIGIT = 0x400
+
+_latin1_classes = array.array('H')
+for _point in range(256):
+    _ch = chr(_point)
+    _bits = 0
+    if _ch.isalnum():
+        _bits |= _ALNUM
+    if _ch.isalpha():
+        _bits |= _ALPHA
+    if _point < 32 or _point == 127:
+        _bits |= _CNTRL
+    else:
+        _bits |= _PRINT
+        if not _ch.isspace():
+            _bits |= _GRAPH
+        if not _ch.isalnum() and _ch != ' ':
+            _bits |= _PUNCT
+    if _ch.isdigit():
+        _bits |= _DIGIT
+    if _ch.islower():
+        _bits |= _LOWER
+    if _ch.isspace():
+        _bits |= _SPACE
+    if _ch.isupper():
+        _bits |= _UPPER
+    if _ch in '0123456789abcdefABCDEF':
+        _bits |= _XDIGIT
+    _latin1_classes.append(_bits)
+
 def IsAlnum(ch):
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _ALNUM
     return ch.isalnum()
 
 def IsAlpha(ch):
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _ALPHA
     return ch.isalpha()
 
 def IsCntrl(ch):
     code = ord(ch)
-    return code < 32 or code == 127
+    if code < 256:
+        return _latin1_classes[code] & _CNTRL
+    return 0
 
 def IsDigit(ch):
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _DIGIT
     return ch.isdigit()
 
 def IsGraph(ch):
-    return IsPrint(ch) and not IsSpace(ch)
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _GRAPH
+    return not ch.isspace()
 
 def IsLower(ch):
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _LOWER
     return ch.islower()
 
 def IsPrint(ch):
-    return not IsCntrl(ch)
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _PRINT
+    return 1
 
 def IsPunct(ch):
-    return IsPrint(ch) and not IsAlnum(ch) and ch != ' '
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _PUNCT
+    return not ch.isalnum()
 
 def IsSpace(ch):
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _SPACE
     return ch.isspace()
 
 def IsUpper(ch):
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _UPPER
     return ch.isupper()
 
 def IsXDigit(ch):
-    return ch in '0123456789abcdefABCDEF'
+    code = ord(ch)
+    if code < 256:
+        return _latin1_classes[code] & _XDIGIT
+    return 0
 
 _class_functions = {
     'alnum': IsAlnum,
@@ -573,21 +1679,115 @@ _class_functions = {
     'xdigit': IsXDigit
 }
 
+def _byteClass(func):
+    # func for bytes, as a lookup in a table of 256 entries - only
+    # ASCII bytes are in a class
+    table = bytearray(256)
+    for i in range(128):
+        if func(chr(i)):
+            table[i] = 1
+    return bytes(table).__getitem__
+
+_byte_class_functions = {}
+for _name, _func in _class_functions.items():
+    _byte_class_functions[_name] = _byteClass(_func)
+
+# Character sets
+#
+# A character is a str of length 1, or an int in a bytes pattern.
+# Sets of characters are kept as sorted intervals of characters, so a
+# range such as [\x00-\uffff] is one interval instead of a key for
+# each character, and a character is found in them by bisection.
+
+def _code(ch):
+    # the code point of a character
+    if ch.__class__ is int:
+        return ch
+    return ord(ch)
+
+def _lowest(ch):
+    # the first character of the kind of ch
+    if ch.__class__ is int:
+        return 0
+    return '\x00'
+
+def _after(ch):
+    # the character after ch, or None if ch is the last character
+    if ch.__class__ is int:
+        if ch == 255:
+            return None
+        return ch + 1
+    code = ord(ch)
+    if code == sys.maxunicode:
+        return None
+    return chr(code + 1)
+
+def _before(ch):
+    # the character before ch
+    if ch.__class__ is int:
+        return ch - 1
+    return chr(ord(ch) - 1)
+
+class CharacterSet:
+
+    # intervals - a sorted list of (lo, hi) pairs, holding the
+    # characters from lo to hi, where no two intervals overlap or touch
+
+    def __init__(self, intervals=()):
+        joined = []
+        for lo, hi in sorted(intervals):
+            if joined:
+                last = joined[-1][1]
+                if lo <= last or lo == _after(last):
+                    if hi > last:
+                        joined[-1] = (joined[-1][0], hi)
+                    continue
+            joined.append((lo, hi))
+        self.intervals = joined
+        self.los = [lo for lo, hi in joined]
+
+    def __contains__(self, ch):
+        i = bisect.bisect_right(self.los, ch) - 1
+        return i >= 0 and ch <= self.intervals[i][1]
+
+    def __len__(self):
+        n = 0
+        for lo, hi in self.intervals:
+            n += _code(hi) - _code(lo) + 1
+        return n
+
+    def __iter__(self):
+        for lo, hi in self.intervals:
+            ch = lo
+            while ch != hi:
+                yield ch
+                ch = _after(ch)
+            yield hi
+
+    def __repr__(self):
+        return 'CharacterSet(%r)' % self.intervals
+
+def _characterSet(chars):
+    # chars as a CharacterSet, if it is a sequence of characters
+    if isinstance(chars, CharacterSet):
+        return chars
+    return CharacterSet([(ch, ch) for ch in chars])
+
 class ComplexCharacterComplement(LinkedNode):
 
     type = TYPE_CHARACTER
 
-    def __init__(self, characters, classes, links=None):
+    def __init__(self, characters, classes, links=None, functions=None):
         LinkedNode.__init__(self, links)
-        self.dict = {}
-        for ch in characters:
-            self.dict[ch] = ch
+        if functions is None:
+            functions = _class_functions
+        self.characters = _characterSet(characters)
         self.funcs = []
         for c in classes:
-            self.funcs.append(_class_functions[c])
+            self.funcs.append(functions[c])
 
     def getMatchedLinks(self, ch):
-        if ch in self.dict:
+        if ch in self.characters:
             return ()
         for func in self.funcs:
             if func(ch):
@@ -596,57 +1796,105 @@ class ComplexCharacterComplement(LinkedNode):
 
 class CharacterMapNode:
 
+    # The links of every character, kept for intervals of characters -
+    # starts is the sorted list of the first character of each
+    # interval, beginning with the lowest character, and segments is
+    # the list of links for each interval.
+
     type = TYPE_CHARACTER
 
     def __init__(self):
-        self.dict = {}
-        self.default = []
+        self.starts = []
+        self.segments = []
 
     def getAllLinks(self):
         linkmap = {}
-        for link in self.default:
-            linkmap[id(link)] = link
-        for links in self.dict.values():
+        for links in self.segments:
             for link in links:
                 linkmap[id(link)] = link
         return linkmap.values()
 
     def getMatchedLinks(self, ch):
-        links = self.dict.get(ch)
-        if links is None:
-            links = self.default
-        return links
+        return self.segments[bisect.bisect_right(self.starts, ch) - 1]
+
+    def getIntervals(self):
+        # the (lo, hi) intervals of characters with links
+        intervals = []
+        starts = self.starts
+        segments = self.segments
+        last = len(starts) - 1
+        for i in range(len(starts)):
+            if segments[i]:
+                if i < last:
+                    hi = _before(starts[i + 1])
+                elif starts[i].__class__ is int:
+                    hi = 255
+                else:
+                    hi = chr(sys.maxunicode)
+                intervals.append((starts[i], hi))
+        return intervals
+
+    def _setIntervals(self, characters, inside, outside):
+        # link the characters of a CharacterSet to inside, and all
+        # other characters to outside
+        starts = []
+        segments = []
+        following = None
+        for lo, hi in characters.intervals:
+            if following is None:
+                following = _lowest(lo)
+            if lo != following:
+                starts.append(following)
+                segments.append(outside)
+            starts.append(lo)
+            segments.append(inside)
+            following = _after(hi)
+        if following is not None:
+            starts.append(following)
+            segments.append(outside)
+        self.starts = starts
+        self.segments = segments
 
 class MutableCharacterMap(CharacterMapNode):
 
     def addMap(self, map):
-        for ch in self.dict.keys():
-            if ch in map.dict:
-                addLinks(self.dict[ch], map.dict[ch])
+        # the links of each character become its links here followed by
+        # its links in map - an interval here is cut where an interval
+        # of map starts, and the new part gets a copy of its links
+        if not self.starts:
+            self.starts = map.starts[:1]
+            self.segments = [[]]
+        starts = self.starts
+        segments = self.segments
+        mapstarts = map.starts
+        for start in mapstarts[1:]:
+            i = bisect.bisect_right(starts, start) - 1
+            if starts[i] != start:
+                starts.insert(i + 1, start)
+                segments.insert(i + 1, segments[i][:])
+        last = len(mapstarts) - 1
+        i = 0
+        for m in range(last + 1):
+            maplinks = map.segments[m]
+            if m < last:
+                end = bisect.bisect_left(starts, mapstarts[m + 1], i)
             else:
-                addLinks(self.dict[ch], map.default)
-        for ch in map.dict.keys():
-            if ch not in self.dict:
-                self.dict[ch] = self.default[:]
-                addLinks(self.dict[ch], map.dict[ch])
-        addLinks(self.default, map.default)
+                end = len(starts)
+            if maplinks:
+                while i < end:
+                    addLinks(segments[i], maplinks)
+                    i += 1
+            i = end
 
 class CharacterMatchNode(CharacterMapNode):
 
     def __init__(self, chars, links):
-        self.dict = {}
-        links = tuple(links)
-        for ch in chars:
-            self.dict[ch] = links
-        self.default = ()
+        self._setIntervals(_characterSet(chars), tuple(links), ())
 
 class CharacterMatchNotNode(CharacterMapNode):
 
     def __init__(self, chars, links):
-        self.dict = {}
-        for ch in chars:
-            self.dict[ch] = ()
-        self.default = tuple(links)
+        self._setIntervals(_characterSet(chars), (), tuple(links))
 
 def print_graph(write, links):
     cnt = 0
@@ -673,10 +1921,8 @@ def print_graph(write, links):
                     write(' Control')
             else:
                 assert link.type is TYPE_CHARACTER
-                if isinstance(link, CharacterMatchNotNode):
-                    write(' CharacterNot(%r)' % link.dict.keys())
-                elif isinstance(link, CharacterMapNode):
-                    write(' Character(%r)' % link.dict.keys())
+                if isinstance(link, CharacterMapNode):
+                    write(' Character(%r)' % link.getIntervals())
                 else:
                     write(' Character')
             for next in link.getAllLinks():
@@ -691,6 +1937,1619 @@ def print_graph(write, links):
             write('\n')
         cnt += 1
 
+# Lazy DFA
+#
+# Without tags, everything a partial match needs to know about its
+# future is the set of nodes it has live (plus any iteration counts),
+# so the set can be used as the state of a DFA.  States and their
+# transitions are built only as the text reaches them, and cached so
+# that each later visit is a single dictionary lookup.  Each partial in
+# the Matcher is still a separate start position, so the leftmost-
+# longest rules in Matcher.addMatch are unchanged.  Reluctant
+# repetitions only change which tags are reported, not the extent or
+# value of a match, so they do not prevent use of the DFA.
+#
+# With tags, the order of the live nodes decides which tags win, so a
+# tagged DFA state is the ordered list of nodes.  Each node in a state
+# has a register holding its tags, and each transition carries a list
+# of (src, count) operations: the new register for each node is the
+# register of node src in the old state with count copies of the
+# current position added (Laurikari's tagged DFA).  Registers are
+# linked lists of (position, rest) pairs, with None for no tags, so an
+# operation never copies the tags already recorded.
+
+DFA_MAX_STATES = 10000
+
+def _stale(counters):
+    # iteration counts once the position has moved on - the last
+    # position only matters while it is equal to the current position
+    return tuple([(slot, count, -1) for slot, count, lastpos in counters])
+
+def _current(counters, currpos):
+    # the iteration counts, with whether each loop was last entered at
+    # currpos - threads which differ only in earlier last positions do
+    # the same from here, so are merged
+    return tuple([(slot, count, lastpos == currpos)
+                                for slot, count, lastpos in counters])
+
+def _pushClosures(stack, closures, links, namespace, currpos):
+    # push the nodes of the closures of links, followed with
+    # namespace, so the first is on top of the stack - returns the
+    # number of namespaces made
+    copies = 0
+    i = len(links)
+    while i > 0:
+        i -= 1
+        for node, pops, ntags in closures[links[i]]:
+            if pops or ntags:
+                counters, tags = namespace
+                if pops:
+                    counters = counters[:-pops]
+                stack.append((node, (counters,
+                                    _pushTags(tags, currpos, ntags))))
+                copies += 1
+            else:
+                stack.append((node, namespace))
+    return copies
+
+def _tagCount(tags):
+    count = 0
+    while tags is not None:
+        tags = tags[1]
+        count += 1
+    return count
+
+def _closure(threads, currpos, final):
+    # Expand the control nodes reachable from threads, in priority
+    # order, the same way Matcher.addChar does.  threads is a sequence
+    # of (node, counters) pairs. Returns a list of (node, namespace,
+    # src) for each match, character and transition node reached,
+    # where src is the index of the thread it was reached from. A
+    # thread which reaches the same node with the same counts as an
+    # earlier thread can only repeat what the earlier thread does, so
+    # it is dropped.
+    result = []
+    seen = {}
+    stack = []
+    src = len(threads)
+    for node, counters in reversed(threads):
+        src -= 1
+        stack.append((node, (counters, None), src))
+    while stack:
+        node, namespace, src = stack.pop()
+        key = (node, namespace[0])
+        if key in seen:
+            continue
+        seen[key] = 1
+        if node.type is TYPE_CONTROL:
+            links, namespace = node.getMatchedLinks(namespace, currpos)
+        elif node.type is TYPE_TRANSITION and final:
+            links = node.getMatchedLinks('', '')
+        else:
+            result.append((node, namespace, src))
+            continue
+        i = len(links)
+        while i > 0:
+            i -= 1
+            stack.append((links[i], namespace, src))
+    return result
+
+def _pushTags(tags, pos, count):
+    while count:
+        tags = (pos, tags)
+        count -= 1
+    return tags
+
+def _tagTuple(tags):
+    # convert a register to the tuple returned by MatchObject.tags()
+    result = []
+    while tags is not None:
+        pos, tags = tags
+        result.append(pos)
+    result.reverse()
+    return tuple(result)
+
+def _getRegs(regs, ops, pos):
+    # apply transition operations to the registers of a partial
+    result = []
+    for src, count in ops:
+        tags = regs[src]
+        while count:
+            tags = (pos, tags)
+            count -= 1
+        result.append(tags)
+    return tuple(result)
+
+def _bestMatch(best, event):
+    # the match to report - lowest index, and then the first reached
+    if best is None or event[0].index() < best[0].index():
+        return event
+    return best
+
+class DFAState:
+
+    def __init__(self, threads, atstart):
+        # threads - the (node, counters) pairs live before the next
+        # character is added
+        self.threads = threads
+        self.atstart = atstart
+        self.next = {}
+        self._final = None
+        # accept, chunkaccept and final are the best Match node reached
+        # (or None), and the (src, count) operation giving its tags
+        accept = None
+        chunkaccept = None
+        self.chunkalive = 0
+        self.chars = []
+        tseen = 0
+        for node, namespace, src in _closure(threads, self.currpos(), 0):
+            if node.type is TYPE_MATCH:
+                event = (node, (src, _tagCount(namespace[1])))
+                accept = _bestMatch(accept, event)
+                if not tseen:
+                    # addChunk must wait for earlier transitions
+                    chunkaccept = _bestMatch(chunkaccept, event)
+            else:
+                self.chunkalive = 1
+                if node.type is TYPE_CHARACTER:
+                    self.chars.append((node, _stale(namespace[0]), src,
+                                                _tagCount(namespace[1])))
+                else:
+                    tseen = 1
+        self.accept, self.accepttags = accept or (None, None)
+        self.chunkaccept, self.chunktags = chunkaccept or (None, None)
+
+    def currpos(self):
+        # the closure only needs to know if we are at position 0
+        if self.atstart:
+            return 0
+        return 1
+
+    def getFinal(self):
+        # the best match, and its tag operation, if the text ends here
+        final = self._final
+        if final is None:
+            final = None
+            for node, namespace, src in _closure(self.threads,
+                                                self.currpos(), 1):
+                if node.type is TYPE_MATCH:
+                    final = _bestMatch(final,
+                                (node, (src, _tagCount(namespace[1]))))
+            self._final = final = final or (None, None)
+        return final
+
+class LazyDFA:
+
+    def __init__(self, pattern, tagged=0, maxstates=None):
+        if maxstates is None:
+            maxstates = DFA_MAX_STATES
+        self.tagged = tagged
+        self.maxstates = maxstates
+        self.states = {}
+        self.flushes = 0
+        self.alphabet = pattern.getAlphabet()
+        self.initial0 = DFAState(((pattern.start0, ()),), 1)
+        self.initial = DFAState(((pattern.start, ()),), 0)
+        # the BitNFA used once the cache overflows, 0 if the pattern
+        # has none, or None until it is needed
+        self.pattern = pattern
+        self.bits = None
+
+    def getBits(self):
+        # Return a BitNFA for the pattern, or None if it is tagged or
+        # has too many positions.
+        if self.bits is None:
+            self.bits = 0
+            if not self.tagged:
+                try:
+                    self.bits = BitNFA(self.pattern)
+                except StateLimitExceeded:
+                    pass
+        return self.bits or None
+
+    def flush(self):
+        # Drop all cached states. States held by a Matcher remain
+        # usable, and will build new states as they are stepped.
+        for state in self.states.values():
+            state.next = {}
+        self.initial0.next = {}
+        self.initial.next = {}
+        self.states = {}
+        self.flushes += 1
+
+    def getState(self, threads):
+        threads = tuple(threads)
+        if self.tagged:
+            key = threads
+        else:
+            key = frozenset(threads)
+        state = self.states.get(key)
+        if state is None:
+            if len(self.states) >= self.maxstates:
+                self.flush()
+            state = DFAState(threads, 0)
+            self.states[key] = state
+        return state
+
+    def step(self, state, cls):
+        # Returns the next state on a character of class cls, or None if
+        # no nodes remain. For a tagged DFA, returns a (state, ops) pair.
+        ch, funcs = self.alphabet.classes[cls]
+        threads = []
+        ops = []
+        seen = {}
+        for node, counters, src, count in state.chars:
+            for link in _classLinks(node, ch, funcs):
+                thread = (link, counters)
+                if thread not in seen:
+                    seen[thread] = 1
+                    threads.append(thread)
+                    ops.append((src, count))
+        if not threads:
+            nextstate = None
+        elif self.tagged:
+            nextstate = (self.getState(threads), tuple(ops))
+        else:
+            nextstate = self.getState(threads)
+        state.next[cls] = nextstate
+        return nextstate
+
+# Reverse search
+#
+# A forward pass with a ScanDFA, which starts a new match after every
+# character without keeping the start positions, finds where the first
+# match ends.  A reverse pass over the text from the last end of a
+# match starting no later, with a ScanDFA of the reversed regexps,
+# then finds the leftmost start, and the match from there is found
+# again with its tags by an anchored Matcher.
+
+def _reverseTree(tree):
+    # The parse tree of a regexp matching the reverse of each text that
+    # tree matches.  Each modifier precedes its atom in the list, so
+    # the order of the (modifiers, atom) units is reversed, the groups
+    # and alternatives within them are reversed in turn, and the
+    # anchors swapped.  Tags are dropped.
+    units = []
+    unit = []
+    while tree:
+        token, data, tree = tree
+        if token is PAREN:
+            data = _reverseTree(data)
+        elif token is CHOICE:
+            data = tuple([_reverseTree(t) for t in data])
+        elif token is STARTANCHOR:
+            token = ENDANCHOR
+        elif token is ENDANCHOR:
+            token = STARTANCHOR
+        unit.append((token, data))
+        if token not in (STAR, PLUS, QMARK, BRACE, RELUCTANT):
+            if token is not HASH:
+                units.append(unit)
+            unit = []
+    tree = None
+    for unit in units:
+        for token, data in reversed(unit):
+            tree = token, data, tree
+    return tree
+
+class ScanDFA:
+
+    # An untagged lazy DFA for the pattern, whose step can also start
+    # a new match after the character.  The next state when starting
+    # is kept in state.next under the key -1 - cls, so it is dropped
+    # with the other next states when the DFA is flushed.
+
+    def __init__(self, pattern):
+        self.dfa = LazyDFA(pattern, 0, pattern.maxstates)
+        self.alphabet = self.dfa.alphabet
+        self.start = (pattern.start, ())
+
+    def step(self, state, cls, starting):
+        # Returns the next state on a character of class cls, or None
+        # if no nodes remain.  If starting is true, the next state also
+        # holds a match started after the character, and is the DFA's
+        # initial state if nothing else remains.
+        dfa = self.dfa
+        if not starting:
+            try:
+                return state.next[cls]
+            except KeyError:
+                return dfa.step(state, cls)
+        try:
+            return state.next[-1 - cls]
+        except KeyError:
+            pass
+        try:
+            nextstate = state.next[cls]
+        except KeyError:
+            nextstate = dfa.step(state, cls)
+        if nextstate is None:
+            nextstate = dfa.initial
+        else:
+            threads = nextstate.threads
+            if self.start not in threads:
+                nextstate = dfa.getState(threads + (self.start,))
+        state.next[-1 - cls] = nextstate
+        return nextstate
+
+# First characters
+#
+# Where every unanchored match must start with a character from a known
+# set, positions which cannot start a match can be skipped without
+# creating a partial for each.  The set is found from the character
+# nodes reachable from Pattern.start without consuming a character.
+
+class FirstCharacters:
+
+    def __init__(self, chars, funcs, binary=0):
+        # chars is a CharacterSet
+        if binary and funcs:
+            # there are only 256 bytes to try
+            intervals = list(chars.intervals)
+            for i in range(256):
+                for func in funcs:
+                    if func(i):
+                        intervals.append((i, i))
+            chars = CharacterSet(intervals)
+            funcs = []
+        self.chars = chars
+        self.funcs = funcs
+        if funcs:
+            self.regexp = None
+        elif binary:
+            self.regexp = re.compile(b'[' + b''.join(
+                    [re.escape(bytes((lo,))) + b'-' + re.escape(bytes((hi,)))
+                        for lo, hi in chars.intervals]) + b']')
+        else:
+            # the re module can look for a set of characters quickly
+            self.regexp = re.compile('[%s]' % ''.join(
+                    [re.escape(lo) + '-' + re.escape(hi)
+                        for lo, hi in chars.intervals]))
+
+    def find(self, text, pos):
+        # index of the first character at or after pos which may start
+        # a match, or len(text)
+        if self.regexp is not None:
+            found = self.regexp.search(text, pos)
+            if found is None:
+                return len(text)
+            return found.start()
+        chars = self.chars
+        funcs = self.funcs
+        n = len(text)
+        while pos < n:
+            ch = text[pos]
+            if ch in chars:
+                return pos
+            for func in funcs:
+                if func(ch):
+                    return pos
+            pos += 1
+        return n
+
+def _firstCharacters(start, binary=0):
+    intervals = []
+    funcs = []
+    for node, namespace, src in _closure(((start, ()),), 1, 0):
+        if node.type is not TYPE_CHARACTER:
+            # a match or end anchor can succeed without a character
+            return None
+        if isinstance(node, CharacterNode):
+            if node.func is Always:
+                return None
+            if node.func not in funcs:
+                funcs.append(node.func)
+        elif isinstance(node, CharacterMapNode) and not node.segments[-1]:
+            intervals.extend(node.getIntervals())
+        else:
+            return None
+    if not intervals and not funcs:
+        return None
+    return FirstCharacters(CharacterSet(intervals), funcs, binary)
+
+# Required literals
+#
+# Most regexps in a large set can only match text containing one of a
+# few literal strings.  These are found from the parse tree of each
+# regexp, and one Aho-Corasick automaton over the literals of all the
+# regexps finds in a single pass which regexps may match a text.  If
+# every regexp has required literals which start within a bounded
+# distance of the start of the match, text far before any literal can
+# also be skipped.
+
+LITERAL_LIMIT = 16      # most strings kept for a subexpression
+PREFILTER_MINIMUM = 16  # fewest regexps worth a prefilter
+SUBPATTERN_LIMIT = 64   # most cached patterns of enabled regexps
+
+# The literal info for an expression is a tuple (exact, prefix,
+# required, offset, maxlen) - the set of strings it matches if there
+# are only a few, a set of strings one of which starts every match, a
+# set of non-empty strings one of which every match contains, the
+# largest offset of that string from the start of the match, and the
+# length of the longest match, each None if unknown or unbounded.
+_EMPTYLITERALS = (frozenset(['']), frozenset(['']), None, None, 0)
+
+def _required(exact):
+    # the strings, if they can be required literals
+    if exact is None or '' in exact:
+        return None
+    return exact
+
+def _betterLiterals(required, offset, required1, offset1):
+    # the more selective of two sets of required literals - beyond
+    # four characters, a literal at a known offset is preferred, since
+    # it also lets the Matcher skip text
+    if required1 is None:
+        return required, offset
+    if required is not None:
+        length = min([len(s) for s in required])
+        length1 = min([len(s) for s in required1])
+        score = (min(length, 4), offset is not None, length,
+                                                        -len(required))
+        score1 = (min(length1, 4), offset1 is not None, length1,
+                                                        -len(required1))
+        if score >= score1:
+            return required, offset
+    return required1, offset1
+
+def _productLiterals(exact, exact1):
+    # the concatenations of a string of exact and a string of exact1,
+    # if there are few enough
+    if exact is None or exact1 is None or \
+                            len(exact) * len(exact1) > LITERAL_LIMIT:
+        return None
+    return frozenset([s + s1 for s in exact for s1 in exact1])
+
+def _concatLiterals(info, info1):
+    # literal info for info followed by info1
+    exact, prefix, required, offset, maxlen = info
+    exact1, prefix1, required1, offset1, maxlen1 = info1
+    if offset1 is not None:
+        if maxlen is None:
+            offset1 = None
+        else:
+            offset1 = maxlen + offset1
+    required, offset = _betterLiterals(required, offset, required1, offset1)
+    if exact is not None:
+        prefix = _productLiterals(exact, prefix1) or exact
+    exact = _productLiterals(exact, exact1)
+    if maxlen is not None and maxlen1 is not None:
+        maxlen = maxlen + maxlen1
+    else:
+        maxlen = None
+    required, offset = _betterLiterals(required, offset,
+                                                    _required(prefix), 0)
+    return exact, prefix, required, offset, maxlen
+
+def _unionLiterals(strings, strings1):
+    if strings is None or strings1 is None or \
+                            len(strings | strings1) > LITERAL_LIMIT:
+        return None
+    return strings | strings1
+
+def _choiceLiterals(infos):
+    # literal info for a choice between infos
+    exact = prefix = required = frozenset()
+    offset = maxlen = 0
+    for exact1, prefix1, required1, offset1, maxlen1 in infos:
+        exact = _unionLiterals(exact, exact1)
+        prefix = _unionLiterals(prefix, prefix1)
+        if required is not None:
+            if required1 is None:
+                required = offset = None
+            else:
+                required = required | required1
+                if offset is not None:
+                    if offset1 is None:
+                        offset = None
+                    else:
+                        offset = max(offset, offset1)
+        if maxlen is not None:
+            if maxlen1 is None:
+                maxlen = None
+            else:
+                maxlen = max(maxlen, maxlen1)
+    required, offset = _betterLiterals(required, offset,
+                                                    _required(prefix), 0)
+    return exact, prefix, required, offset, maxlen
+
+def _repeatLiterals(info, lower, upper):
+    # literal info for info repeated lower to upper times
+    exact, prefix, required, offset, maxlen = info
+    if upper is None or maxlen is None:
+        maxlen = None
+    else:
+        maxlen = upper * maxlen
+    if lower == 0:
+        if upper == 1:
+            exact = _unionLiterals(exact, _EMPTYLITERALS[0])
+            prefix = _unionLiterals(prefix, _EMPTYLITERALS[0])
+        else:
+            exact = prefix = None
+        return exact, prefix, None, None, maxlen
+    # the first lower repeats start every match
+    first = exact
+    for i in range(lower - 1):
+        first = _productLiterals(first, exact)
+    if first is not None:
+        prefix = first
+    required, offset = _betterLiterals(required, offset,
+                                                    _required(prefix), 0)
+    if lower != upper:
+        first = None
+    return first, prefix, required, offset, maxlen
+
+def _atomLiterals(token, data):
+    if token is CHAR:
+        exact = frozenset([data])
+        return exact, exact, exact, 0, 1
+    elif token is BRACKET:
+        characters, classes, compl = _bracket(data)
+        if compl or classes or len(characters) > LITERAL_LIMIT:
+            return None, None, None, None, 1
+        exact = frozenset(characters)
+        return exact, exact, exact, 0, 1
+    elif token is PAREN:
+        return _literals(data)
+    elif token is STARTANCHOR or token is ENDANCHOR:
+        return _EMPTYLITERALS
+    else:
+        assert token is DOT, token
+        return None, None, None, None, 1
+
+def _literals(tree):
+    # literal info for a tree returned by scan(), which has already
+    # been compiled without error - this follows Pattern._comp
+    info = _EMPTYLITERALS
+    while tree:
+        token, data, tree = tree
+        if token is BRACE or token is RELUCTANT:
+            brstart, brend = data
+            lower = int(brstart)
+            if brend is None:
+                upper = lower
+            elif not brend:
+                upper = None
+            else:
+                upper = int(brend)
+            token, data, tree = tree
+            if upper != 0:
+                info = _concatLiterals(_repeatLiterals(
+                        _atomLiterals(token, data), lower, upper), info)
+        elif token is STAR:
+            tree = BRACE, (0, ''), tree
+        elif token is PLUS:
+            tree = BRACE, (1, ''), tree
+        elif token is QMARK:
+            token, data, tree = tree
+            if token is BRACE:
+                tree = RELUCTANT, data, tree
+            elif token is STAR:
+                tree = RELUCTANT, (0, ''), tree
+            elif token is PLUS:
+                tree = RELUCTANT, (1, ''), tree
+            elif token is QMARK:
+                tree = RELUCTANT, (0, 1), tree
+            else:
+                tree = token, data, tree
+                tree = BRACE, (0, 1), tree
+        elif token is CHOICE:
+            info = _concatLiterals(_choiceLiterals(
+                                [_literals(t) for t in data]), info)
+        elif token is not HASH:
+            info = _concatLiterals(_atomLiterals(token, data), info)
+    return info
+
+class AhoCorasick:
+
+    def __init__(self, literals):
+        # a trie of the literals, where out lists the lengths of the
+        # literals ending at each state, longest first
+        goto = [{}]
+        out = [[]]
+        for literal in literals:
+            state = 0
+            for ch in literal:
+                nextstate = goto[state].get(ch)
+                if nextstate is None:
+                    nextstate = len(goto)
+                    goto[state][ch] = nextstate
+                    goto.append({})
+                    out.append([])
+                state = nextstate
+            out[state].append(len(literal))
+        # failure links, breadth first so that the failure state of a
+        # state's parent is always complete
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            for ch, nextstate in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[nextstate] = f
+                out[nextstate] = out[nextstate] + out[f]
+                queue.append(nextstate)
+        for lengths in out:
+            lengths.sort()
+            lengths.reverse()
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+        self.maxlen = max([len(literal) for literal in literals])
+        # transitions for each state, filled in as they are used
+        self.next = [{} for state in goto]
+
+    def step(self, state, ch):
+        goto = self.goto
+        s = state
+        while ch not in goto[s]:
+            if s == 0:
+                self.next[state][ch] = 0
+                return 0
+            s = self.fail[s]
+        nextstate = goto[s][ch]
+        self.next[state][ch] = nextstate
+        return nextstate
+
+    def findall(self, text):
+        # the states at which a literal ends while reading text
+        found = {}
+        nexts = self.next
+        out = self.out
+        state = 0
+        for ch in text:
+            try:
+                state = nexts[state][ch]
+            except KeyError:
+                state = self.step(state, ch)
+            if out[state]:
+                found[state] = 1
+        return found
+
+    def search(self, text, pos):
+        # the least start at or after pos of a literal in text, or None
+        nexts = self.next
+        out = self.out
+        maxlen = self.maxlen
+        best = None
+        state = 0
+        n = len(text)
+        while pos < n:
+            if best is not None and pos - maxlen >= best:
+                # any literal ending here starts after best
+                break
+            ch = text[pos]
+            try:
+                state = nexts[state][ch]
+            except KeyError:
+                state = self.step(state, ch)
+            if out[state]:
+                start = pos + 1 - out[state][0]
+                if best is None or start < best:
+                    best = start
+            pos += 1
+        return best
+
+class Prefilter:
+
+    def __init__(self, regexps, binary=0):
+        # regexps is a list of (links, required, offset), with the
+        # literals as str - for a bytes pattern, each character is a
+        # byte
+        self.binary = binary
+        literals = []
+        indexes = {}
+        self.always = []
+        window = 0
+        for regexp in range(len(regexps)):
+            links, required, offset = regexps[regexp]
+            if required is None:
+                self.always.append(regexp)
+                window = None
+                continue
+            if window is not None:
+                if offset is None:
+                    window = None
+                else:
+                    window = max(window, offset)
+            for literal in required:
+                if binary:
+                    literal = literal.encode('latin-1')
+                if literal not in indexes:
+                    indexes[literal] = []
+                    literals.append(literal)
+                indexes[literal].append(regexp)
+        self.automaton = automaton = AhoCorasick(literals)
+        # the regexps requiring the literal ending at each state
+        self.ends = ends = {}
+        for literal, regexps in indexes.items():
+            ends[self._endState(literal)] = regexps
+        # the regexps enabled by reaching each state, made as needed
+        self.owners = {}
+        # the largest offset of a required literal from the start of a
+        # match, or None if there is no bound
+        self.window = window
+
+    def _endState(self, literal):
+        # the state for literal, or None if it is not in the automaton
+        goto = self.automaton.goto
+        state = 0
+        for ch in literal:
+            state = goto[state].get(ch)
+            if state is None:
+                return None
+        return state
+
+    def _owners(self, state):
+        enabled = {}
+        while state:
+            for regexp in self.ends.get(state, ()):
+                enabled[regexp] = 1
+            state = self.automaton.fail[state]
+        return list(enabled.keys())
+
+    def enabled(self, text):
+        # the regexps which may match text, as a dictionary
+        enabled = {}
+        for regexp in self.always:
+            enabled[regexp] = 1
+        owners = self.owners
+        for state in self.automaton.findall(text).keys():
+            regexps = owners.get(state)
+            if regexps is None:
+                regexps = owners[state] = self._owners(state)
+            for regexp in regexps:
+                enabled[regexp] = 1
+        return enabled
+
+    def add(self, regexp, required, offset):
+        # Add regexp, with its required literals.  Returns false, and
+        # changes nothing, if a literal is not in the automaton, which
+        # must then be built again.
+        if required is None:
+            self.always.append(regexp)
+            self.window = None
+            return 1
+        states = []
+        for literal in required:
+            if self.binary:
+                literal = literal.encode('latin-1')
+            state = self._endState(literal)
+            if state not in self.ends:
+                return 0
+            states.append(state)
+        for state in states:
+            self.ends[state].append(regexp)
+        if self.window is not None:
+            if offset is None:
+                self.window = None
+            else:
+                self.window = max(self.window, offset)
+        self.owners = {}
+        return 1
+
+    def remove(self, regexp, regexps):
+        # Remove regexp, numbering the regexps after it one lower, where
+        # regexps is the list of the regexps left.  The literals stay in
+        # the automaton, which still finds them, but enables nothing.
+        def renumber(numbers):
+            return [n - (n > regexp) for n in numbers if n != regexp]
+        self.always = renumber(self.always)
+        for state, numbers in self.ends.items():
+            self.ends[state] = renumber(numbers)
+        self.owners = {}
+        window = 0
+        for links, required, offset in regexps:
+            if required is None or offset is None:
+                window = None
+                break
+            window = max(window, offset)
+        self.window = window
+
+    def find(self, text, pos):
+        # index of the first position at or after pos at which a match
+        # may start, allowing for literals continued in later text
+        automaton = self.automaton
+        limit = len(text) + 1 - automaton.maxlen
+        start = automaton.search(text, pos)
+        if start is not None and start < limit:
+            limit = start
+        return max(pos, limit - self.window)
+
+# Full DFA
+#
+# A full DFA is built ahead of time from every state reachable from
+# the start nodes, minimized, and frozen into flat tables.  Since the
+# text may contain any character, the DFA steps on the character
+# classes of the pattern's Alphabet rather than characters.  Only
+# tag-free patterns can be compiled this way.
+
+class StateLimitExceeded(Exception):
+    pass
+
+def _reachable(starts):
+    # all nodes reachable from the start nodes
+    nodes = []
+    seen = {}
+    stack = list(starts)
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen[id(node)] = 1
+        nodes.append(node)
+        if node.type is not TYPE_MATCH:
+            stack.extend(node.getAllLinks())
+    return nodes
+
+# Epsilon closures
+#
+# Option, tag and loop exit nodes, and control nodes which always pass,
+# follow all their links whatever the namespace, so the nodes reached
+# through them can be found once for the whole graph.  The closure of
+# a node lists the other nodes reached - character, match and
+# transition nodes, and control nodes which test the namespace or the
+# position - with the number of loop counters a thread leaves and the
+# number of tags it sets on the way.  A node reached a second time
+# would only repeat the threads of the first, so only the first is
+# kept, as the Matcher would.  The closures are in reverse priority
+# order, ready to push on a stack.
+
+def _isEpsilon(node):
+    # true for a node which always follows all its links
+    cls = node.__class__
+    return (
+        cls is OptionalNode or cls is TagControlNode or
+        cls is IterationExitNode or
+        (cls is ControlNode and node.func is Always)
+    )
+
+def _epsilonClosures(nodes):
+    # a dict of the closure of each of nodes, as a tuple of (node,
+    # counters left, tags set)
+    closures = {}
+    for start in nodes:
+        if not _isEpsilon(start):
+            closures[start] = ((start, 0, 0),)
+            continue
+        closure = []
+        seen = {}
+        stack = [(start, 0, 0)]
+        while stack:
+            node, pops, ntags = stack.pop()
+            if node in seen:
+                continue
+            seen[node] = 1
+            if not _isEpsilon(node):
+                closure.append((node, pops, ntags))
+                continue
+            if node.__class__ is IterationExitNode:
+                pops += 1
+            elif node.__class__ is TagControlNode:
+                ntags += 1
+            links = node.getAllLinks()
+            i = len(links)
+            while i > 0:
+                i -= 1
+                stack.append((links[i], pops, ntags))
+        closure.reverse()
+        closures[start] = tuple(closure)
+    return closures
+
+# Alphabet
+#
+# The characters are split into classes, where every character node of
+# a pattern treats all the characters of a class the same, so a DFA
+# steps on the class of each character instead of the character.  The
+# character intervals of all the nodes are cut where any node's
+# intervals start, and each interval is split again by which of the
+# [:class:] functions its characters satisfy.  These cells are then
+# joined into classes by partition refinement: each node only splits
+# the blocks holding cells for which it has links.
+
+def _classLinks(node, ch, funcs):
+    # the links followed by a character node for a character class -
+    # ch is a character of the class, and funcs is the set of class
+    # functions it satisfies
+    if isinstance(node, CharacterMapNode):
+        return node.getMatchedLinks(ch)
+    elif isinstance(node, ComplexCharacterComplement):
+        if ch in node.characters:
+            return ()
+        for func in node.funcs:
+            if func in funcs:
+                return ()
+        return node.getAllLinks()
+    else:
+        assert isinstance(node, CharacterNode)
+        if node.func is Always or node.func in funcs:
+            return node.getAllLinks()
+        return ()
+
+# most characters in an interval whose class functions are each found
+# by Alphabet - a longer interval has a cell for every combination
+ALPHABET_SCAN_LIMIT = 256
+
+class Alphabet:
+
+    def __init__(self, charnodes, binary=0):
+        if binary:
+            lowest = 0
+            end = 256
+        else:
+            lowest = '\x00'
+            end = sys.maxunicode + 1
+        starts = {lowest: 1}
+        funcs = {}
+        for node in charnodes:
+            if isinstance(node, CharacterNode):
+                if node.func is not Always:
+                    funcs[node.func] = 1
+            elif isinstance(node, ComplexCharacterComplement):
+                for func in node.funcs:
+                    funcs[func] = 1
+                for lo, hi in node.characters.intervals:
+                    starts[lo] = 1
+                    following = _after(hi)
+                    if following is not None:
+                        starts[following] = 1
+            else:
+                for start in node.starts:
+                    starts[start] = 1
+        self.binary = binary
+        self.funcs = list(funcs.keys())
+        # starts - the first character of each interval in which every
+        # node has the same links for each character
+        self.starts = starts = sorted(starts.keys())
+        # cells - an (interval, vector of class functions) pair for each
+        # vector found in each interval
+        n = len(self.funcs)
+        allvectors = []
+        for i in range(1 << n):
+            allvectors.append(tuple([(i >> j) & 1 for j in range(n)]))
+        cells = []
+        intervalcells = []
+        for i in range(len(starts)):
+            if n == 0:
+                vectors = allvectors
+            else:
+                lo = _code(starts[i])
+                if i + 1 < len(starts):
+                    hi = _code(starts[i + 1])
+                else:
+                    hi = end
+                if hi - lo > ALPHABET_SCAN_LIMIT:
+                    vectors = allvectors
+                else:
+                    vectors = {}
+                    for code in range(lo, hi):
+                        if binary:
+                            vectors[self.getVector(code)] = 1
+                        else:
+                            vectors[self.getVector(chr(code))] = 1
+            intervalcells.append(range(len(cells), len(cells) + len(vectors)))
+            for vector in vectors:
+                cells.append((i, vector))
+        # blocks - the block of each cell, refined by each node
+        blocks = [0] * len(cells)
+        nblocks = 1
+        cellfuncs = [self.getFuncs(vector) for i, vector in cells]
+        for node in charnodes:
+            touched = []
+            if isinstance(node, CharacterMapNode):
+                nodestarts = node.starts
+                last = len(nodestarts) - 1
+                for m in range(last + 1):
+                    links = node.segments[m]
+                    if not links:
+                        continue
+                    i = bisect.bisect_left(starts, nodestarts[m])
+                    if m < last:
+                        j = bisect.bisect_left(starts, nodestarts[m + 1], i)
+                    else:
+                        j = len(starts)
+                    value = tuple(map(id, links))
+                    for i in range(i, j):
+                        for cell in intervalcells[i]:
+                            touched.append((cell, value))
+            else:
+                for cell in range(len(cells)):
+                    links = _classLinks(node, starts[cells[cell][0]],
+                                                        cellfuncs[cell])
+                    if links:
+                        touched.append((cell, tuple(map(id, links))))
+            split = {}
+            for cell, value in touched:
+                key = (blocks[cell], value)
+                block = split.get(key)
+                if block is None:
+                    block = split[key] = nblocks
+                    nblocks += 1
+                blocks[cell] = block
+        # classes - a (ch, funcs) representative for each class
+        self.classes = []
+        # table - class of each (interval, vector) cell
+        self.table = {}
+        # map - class of each character seen so far
+        self.map = {}
+        numbers = {}
+        for cell in range(len(cells)):
+            i, vector = cells[cell]
+            cls = numbers.get(blocks[cell])
+            if cls is None:
+                cls = numbers[blocks[cell]] = len(self.classes)
+                self.classes.append((starts[i], cellfuncs[cell]))
+            self.table[i, vector] = cls
+
+    def getVector(self, ch):
+        return tuple([func(ch) and 1 or 0 for func in self.funcs])
+
+    def getFuncs(self, vector):
+        funcs = {}
+        for func, bit in zip(self.funcs, vector):
+            if bit:
+                funcs[func] = 1
+        return funcs
+
+    def getClass(self, ch):
+        cls = self.map.get(ch)
+        if cls is None:
+            i = bisect.bisect_right(self.starts, ch) - 1
+            cls = self.map[ch] = self.table[i, self.getVector(ch)]
+        return cls
+
+    def getIntervals(self):
+        # The (lo, hi, classes) triple for each interval of characters,
+        # where classes maps each tuple of [:class:] function results
+        # (in the order of self.funcs) found in the interval to the
+        # class of its characters.  With no class functions, the only
+        # key is ().
+        intervals = []
+        starts = self.starts
+        for i in range(len(starts)):
+            if i + 1 < len(starts):
+                hi = _before(starts[i + 1])
+            elif self.binary:
+                hi = 255
+            else:
+                hi = chr(sys.maxunicode)
+            intervals.append((starts[i], hi, {}))
+        for (i, vector), cls in self.table.items():
+            intervals[i][2][vector] = cls
+        return intervals
+
+def _hopcroft(blocks, rows, nclasses):
+    # Refine a partition of the states (a list of lists) until states
+    # in the same block go to the same block on every class. Returns
+    # the block number of each state.
+    nstates = len(rows)
+    inverse = []
+    for cls in range(nclasses):
+        inverse.append({})
+    for s in range(nstates):
+        row = rows[s]
+        for cls in range(nclasses):
+            inverse[cls].setdefault(row[cls], []).append(s)
+    blockof = [0] * nstates
+    sets = []
+    for members in blocks:
+        for s in members:
+            blockof[s] = len(sets)
+        sets.append(set(members))
+    work = list(range(len(sets)))
+    inwork = set(work)
+    while work:
+        b = work.pop()
+        inwork.discard(b)
+        targets = list(sets[b])
+        for cls in range(nclasses):
+            inv = inverse[cls]
+            touched = {}
+            for t in targets:
+                for s in inv.get(t, ()):
+                    touched.setdefault(blockof[s], []).append(s)
+            for y, members in touched.items():
+                if len(members) == len(sets[y]):
+                    continue
+                z = len(sets)
+                split = set(members)
+                sets[y] -= split
+                sets.append(split)
+                for s in members:
+                    blockof[s] = z
+                if y in inwork or len(split) <= len(sets[y]):
+                    work.append(z)
+                    inwork.add(z)
+                else:
+                    work.append(y)
+                    inwork.add(y)
+    return blockof, len(sets)
+
+class FrozenState:
+
+    def __init__(self, number, accept, chunkaccept, final, chunkalive):
+        self.number = number
+        self.accept = accept
+        self.chunkaccept = chunkaccept
+        self.final = final
+        self.chunkalive = chunkalive
+        self.accepttags = self.chunktags = None
+        # row - next state (or None) for each character class, or for
+        # each byte if the pattern is bytes
+        self.row = None
+
+    def getFinal(self):
+        return self.final, None
+
+class FullDFA:
+
+    tagged = 0
+
+    def __init__(self, pattern, maxstates=None):
+        if maxstates is None:
+            maxstates = DFA_MAX_STATES
+        if pattern.tagged:
+            raise StateLimitExceeded('tagged patterns need a lazy DFA')
+        self.alphabet = alphabet = pattern.getAlphabet()
+        self.binary = pattern.binary
+        nclasses = len(alphabet.classes)
+        # subset construction - state 0 is the dead state
+        states = [None]
+        index = {}
+        rows = [[0] * nclasses]
+        for start, atstart in ((pattern.start0, 1), (pattern.start, 0)):
+            states.append(DFAState(((start, ()),), atstart))
+            rows.append(None)
+        i = 1
+        while i < len(states):
+            state = states[i]
+            row = []
+            for ch, funcs in alphabet.classes:
+                threads = []
+                seen = {}
+                for node, counters, src, count in state.chars:
+                    for link in _classLinks(node, ch, funcs):
+                        thread = (link, counters)
+                        if thread not in seen:
+                            seen[thread] = 1
+                            threads.append(thread)
+                if not threads:
+                    row.append(0)
+                    continue
+                key = frozenset(threads)
+                n = index.get(key)
+                if n is None:
+                    if len(states) > maxstates:
+                        raise StateLimitExceeded(
+                                'more than %d DFA states' % maxstates)
+                    n = index[key] = len(states)
+                    states.append(DFAState(tuple(threads), 0))
+                    rows.append(None)
+                row.append(n)
+            rows[i] = row
+            i += 1
+        self.nbuilt = len(states) - 1
+        # minimize, starting from states with the same matches
+        blocks = {}
+        for n in range(len(states)):
+            state = states[n]
+            if state is None:
+                key = None
+            else:
+                key = (_matchIndex(state.accept),
+                        _matchIndex(state.chunkaccept),
+                        _matchIndex(state.getFinal()[0]),
+                        state.chunkalive)
+            blocks.setdefault(key, []).append(n)
+        # keep the dead state first, so it stays block 0
+        blocks = [blocks.pop(None)] + list(blocks.values())
+        blockof, nblocks = _hopcroft(blocks, rows, nclasses)
+        # freeze into flat tables, with -1 for the dead state
+        self.nclasses = nclasses
+        self.nstates = nblocks - 1
+        self.trans = [-1] * (self.nstates * nclasses)
+        self.accepts = [None] * self.nstates
+        self.chunkaccepts = [None] * self.nstates
+        self.finals = [None] * self.nstates
+        self.chunkalives = [0] * self.nstates
+        for n in range(1, len(states)):
+            s = blockof[n] - 1
+            state = states[n]
+            self.accepts[s] = state.accept
+            self.chunkaccepts[s] = state.chunkaccept
+            self.finals[s] = state.getFinal()[0]
+            self.chunkalives[s] = state.chunkalive
+            base = s * nclasses
+            row = rows[n]
+            for cls in range(nclasses):
+                self.trans[base + cls] = blockof[row[cls]] - 1
+        self.start0 = blockof[1] - 1
+        self.start = blockof[2] - 1
+        self.arrays = None
+        self._thaw()
+
+    def _thaw(self):
+        # build the state objects used by Matcher from the tables
+        nclasses = self.nclasses
+        objects = []
+        for s in range(self.nstates):
+            objects.append(FrozenState(s, self.accepts[s],
+                        self.chunkaccepts[s], self.finals[s],
+                        self.chunkalives[s]))
+        if self.binary:
+            # a row with an entry for each byte, saving the class lookup
+            classes = [self.alphabet.getClass(i) for i in range(256)]
+        for s in range(self.nstates):
+            row = []
+            for t in self.trans[s * nclasses:(s + 1) * nclasses]:
+                if t < 0:
+                    row.append(None)
+                else:
+                    row.append(objects[t])
+            if self.binary:
+                row = [row[cls] for cls in classes]
+            objects[s].row = row
+        self.initial0 = objects[self.start0]
+        self.initial = objects[self.start]
+
+    def getArrays(self):
+        # the tables as numpy arrays, for matchMany - the transitions,
+        # with state nstates as the dead state, then for each state the
+        # index in matches of its accept and of its final, or -1
+        if self.arrays is None:
+            nstates = self.nstates
+            nclasses = self.nclasses
+            trans = numpy.array(self.trans + [nstates] * nclasses,
+                                    dtype=numpy.intp)
+            trans[trans < 0] = nstates
+            trans = trans.reshape(nstates + 1, nclasses)
+            matches = []
+            indexes = {}
+            codes = []
+            for table in (self.accepts, self.finals):
+                row = []
+                for match in table:
+                    if match is None:
+                        row.append(-1)
+                        continue
+                    if match not in indexes:
+                        indexes[match] = len(matches)
+                        matches.append(match)
+                    row.append(indexes[match])
+                row.append(-1)
+                codes.append(numpy.array(row, dtype=numpy.intp))
+            if self.binary:
+                bytemap = numpy.array(
+                        [self.alphabet.getClass(i) for i in range(256)],
+                        dtype=numpy.intp)
+            else:
+                bytemap = None
+            self.arrays = trans, codes[0], codes[1], matches, bytemap
+        return self.arrays
+
+    def getClasses(self, texts):
+        # the class of each character of texts, as a 2D array padded
+        # with class 0, and the length of each text
+        lengths = numpy.array([len(text) for text in texts],
+                                    dtype=numpy.intp)
+        width = max(int(lengths.max()), 1)
+        if self.binary:
+            texts = [bytes(text) for text in texts]
+            chars = numpy.array(texts, dtype='S%d' % width).view(
+                                numpy.uint8).reshape(len(texts), width)
+            return self.getArrays()[4][chars], lengths
+        # numpy keeps each str as UTF-32, so the characters are the code
+        # points, which are classified once each
+        chars = numpy.array(texts, dtype='U%d' % width).view(
+                                numpy.uint32).reshape(-1)
+        points, inverse = numpy.unique(chars, return_inverse=True)
+        getClass = self.alphabet.getClass
+        classes = numpy.array([getClass(chr(point)) for point in points],
+                                    dtype=numpy.intp)
+        classes = classes[inverse.reshape(-1)].reshape(len(texts), width)
+        return classes, lengths
+
+    def matchMany(self, texts):
+        # Search each of texts, as Matcher.addFinal would, stepping all
+        # of them together. Returns arrays of the start and end of the
+        # match in each text (-1 if none) and of the index of its Match
+        # in matches, and the list matches.
+        trans, accepts, finals, matches, bytemap = self.getArrays()
+        n = len(texts)
+        starts = numpy.full(n, -1, dtype=numpy.intp)
+        ends = numpy.full(n, -1, dtype=numpy.intp)
+        codes = numpy.full(n, -1, dtype=numpy.intp)
+        if n == 0:
+            return starts, ends, codes, matches
+        classes, lengths = self.getClasses(texts)
+        dead = self.nstates
+        # the leftmost match wins, so each round tries one start
+        # position in each text not yet matched, and later ends
+        # found in the round overwrite earlier ones
+        startpos = 0
+        while 1:
+            lanes = numpy.nonzero((starts < 0) &
+                                    (lengths >= startpos))[0]
+            if len(lanes) == 0:
+                break
+            if startpos == 0:
+                initial = self.start0
+            else:
+                initial = self.start
+            states = numpy.full(len(lanes), initial, dtype=numpy.intp)
+            pos = startpos
+            while 1:
+                atend = lengths[lanes] == pos
+                found = numpy.where(atend, finals[states], accepts[states])
+                hit = found >= 0
+                if hit.any():
+                    matched = lanes[hit]
+                    starts[matched] = startpos
+                    ends[matched] = pos
+                    codes[matched] = found[hit]
+                live = ~atend
+                lanes = lanes[live]
+                if len(lanes) == 0:
+                    break
+                states = trans[states[live], classes[lanes, pos]]
+                live = states != dead
+                lanes = lanes[live]
+                states = states[live]
+                pos += 1
+            startpos += 1
+        return starts, ends, codes, matches
+
+# Bit-parallel NFA
+#
+# A small pattern without tags can be run as an NFA whose live threads
+# are the bits of an int.  Each position is a character node, with the
+# iteration counts it was reached with, ready to read the next
+# character, and bit 0 stands for any transition node, which can only
+# succeed at the end of the text.  For each character class, the steps
+# of the positions give the positions and matches reached, as bits, so
+# stepping a set of threads is an OR of the steps of its bits, and the
+# positions which only lead to the next position, as in a run of
+# literal characters, step together in one shift.  Matches are bits in
+# order of their index, so the lowest bit set is the best match.
+
+BITS_MAX_POSITIONS = 64
+
+class BitNFA:
+
+    tagged = 0
+
+    def __init__(self, pattern, maxpositions=None):
+        if maxpositions is None:
+            maxpositions = BITS_MAX_POSITIONS
+        if pattern.tagged:
+            raise StateLimitExceeded('tagged patterns need a lazy DFA')
+        self.maxpositions = maxpositions
+        self.alphabet = alphabet = pattern.getAlphabet()
+        self.matches = [node for node in
+                            _reachable([pattern.start0, pattern.start])
+                                        if node.type is TYPE_MATCH]
+        self.matches.sort(key=Match.index)
+        self.matchbits = {}
+        for i in range(len(self.matches)):
+            self.matchbits[self.matches[i]] = 1 << i
+        # the (node, counters) of each position, by bit number
+        self.positions = [None]
+        self.numbers = {}
+        # (live, accept, final) - the positions live, the matches
+        # reached, and the matches if the text ends
+        self.initial0 = self._getStep(((pattern.start0, ()),), 0)
+        self.initial = self._getStep(((pattern.start, ()),), 1)
+        rows = [None]
+        i = 1
+        while i < len(self.positions):
+            node, counters = self.positions[i]
+            row = []
+            for ch, funcs in alphabet.classes:
+                threads = [(link, counters)
+                                for link in _classLinks(node, ch, funcs)]
+                if threads:
+                    row.append(self._getStep(threads, 1))
+                else:
+                    row.append(None)
+            rows.append(row)
+            i += 1
+        self.npositions = len(self.positions) - 1
+        # for each class, the positions which step to the next, and the
+        # step of each other position that does not die, by its bit
+        self.steps = []
+        for cls in range(len(alphabet.classes)):
+            linear = 0
+            other = {}
+            for i in range(1, len(rows)):
+                step = rows[i][cls]
+                if step is None:
+                    continue
+                bit = 1 << i
+                if step == (bit << 1, 0, 0):
+                    linear |= bit
+                else:
+                    other[bit] = step
+            self.steps.append((linear, other))
+
+    def _getStep(self, threads, currpos):
+        live = accept = final = 0
+        for node, namespace, src in _closure(threads, currpos, 0):
+            if node.type is TYPE_MATCH:
+                accept |= self.matchbits[node]
+            elif node.type is TYPE_CHARACTER:
+                key = (node, _stale(namespace[0]))
+                number = self.numbers.get(key)
+                if number is None:
+                    if len(self.positions) > self.maxpositions:
+                        raise StateLimitExceeded(
+                            'more than %d positions' % self.maxpositions)
+                    number = self.numbers[key] = len(self.positions)
+                    self.positions.append(key)
+                live |= 1 << number
+            else:
+                live |= 1
+        for node, namespace, src in _closure(threads, currpos, 1):
+            if node.type is TYPE_MATCH:
+                final |= self.matchbits[node]
+        return live, accept, final
+
+    def getState(self, state):
+        # the (live, accept, final) bits of the threads of a DFAState
+        return self._getStep(state.threads, state.currpos())
+
+    def getMatch(self, bits):
+        # the best match of the matches set in bits
+        return self.matches[(bits & -bits).bit_length() - 1]
+
+# Code generation
+#
+# The full DFA of a pattern can be written out as the source of a
+# Python module, with the transitions, matches and character classes
+# as tuples, and the Matcher's loop over the text written out in one
+# function, so each character costs a few lookups in local variables
+# rather than calls on state and node objects.  The source does not
+# depend on the pattern, so it can be saved as a module and imported
+# without compiling the regexps again.
+
+def _pythonSource(pattern, dfa, name):
+    alphabet = dfa.alphabet
+    numbers = {}
+    for number in range(len(pattern.matches)):
+        numbers[pattern.matches[number]] = number
+    def codes(matches):
+        return tuple([numbers.get(match, -1) for match in matches])
+    first = pattern.getFirstCharacters()
+    if first is not None:
+        first = first.regexp
+    lines = [
+        '# Generated by Trespass %s from the regexps:' % __version__,
+    ]
+    for source in pattern.sources:
+        lines.append('#     %r' % (source,))
+    lines.extend([
+        '# %s(text) returns the (start, end, regexp) of the match that' %
+                                                                    name,
+        '# Pattern.match finds in text, where regexp is the number of',
+        '# the regexp in the order they were added, or None.',
+        '',
+        'import bisect',
+        'import re',
+        '',
+        'NCLASSES = %d' % dfa.nclasses,
+        'START0 = %d' % dfa.start0,
+        'START = %d' % dfa.start,
+        'TRANS = %r' % (tuple(dfa.trans),),
+        'ACCEPTS = %r' % (codes(dfa.accepts),),
+        'FINALS = %r' % (codes(dfa.finals),),
+    ])
+    if first is None:
+        lines.append('FIRST = None')
+    else:
+        lines.append('FIRST = re.compile(%r)' % (first.pattern,))
+    if dfa.binary:
+        lines.append('BYTECLASSES = %r' % (tuple(
+                    [alphabet.getClass(i) for i in range(256)]),))
+    elif alphabet.funcs:
+        lines.extend([
+            'import Trespass',
+            'if Trespass.FORMAT_VERSION != %d:' % FORMAT_VERSION,
+            '    raise ImportError(\'generated by another Trespass\')',
+            'FUNCS = tuple([Trespass._FUNCTIONS[number] for number in %r])'
+                    % (tuple([_function_numbers[func]
+                                for func in alphabet.funcs]),),
+            'STARTS = %r' % (tuple(alphabet.starts),),
+            'TABLE = %r' % (alphabet.table,),
+            'CLASSMAP = {}',
+            '',
+            'def _getClass(ch):',
+            '    i = bisect.bisect_right(STARTS, ch) - 1',
+            '    vector = tuple([func(ch) and 1 or 0 for func in FUNCS])',
+            '    cls = CLASSMAP[ch] = TABLE[i, vector]',
+            '    return cls',
+        ])
+    else:
+        lines.extend([
+            'STARTS = %r' % (tuple(alphabet.starts),),
+            'CLASSES = %r' % (tuple([alphabet.table[i, ()]
+                                for i in range(len(alphabet.starts))]),),
+            'CLASSMAP = {}',
+            '',
+            'def _getClass(ch):',
+            '    cls = CLASSMAP[ch] = CLASSES[',
+            '                    bisect.bisect_right(STARTS, ch) - 1]',
+            '    return cls',
+        ])
+    lines.extend([
+        '',
+        'def %s(text, trans=TRANS, accepts=ACCEPTS, nclasses=NCLASSES):'
+                                                                    % name,
+        '    n = len(text)',
+        '    partials = [(0, START0)]',
+        '    left = right = regexp = -1',
+        '    pos = 0',
+        '    while pos < n:',
+    ])
+    if dfa.binary:
+        lines.append('        cls = BYTECLASSES[text[pos]]')
+    else:
+        lines.extend([
+            '        ch = text[pos]',
+            '        cls = CLASSMAP.get(ch)',
+            '        if cls is None:',
+            '            cls = _getClass(ch)',
+        ])
+    lines.extend([
+        '        nextpartials = []',
+        '        seen = set()',
+        '        for start, state in partials:',
+        '            if left >= 0 and start > left:',
+        '                break',
+        '            found = accepts[state]',
+        '            if found >= 0:',
+        '                # no other partial has the same start',
+        '                left = start',
+        '                right = pos',
+        '                regexp = found',
+        '            state = trans[state * nclasses + cls]',
+        '            if state >= 0 and state not in seen:',
+        '                seen.add(state)',
+        '                nextpartials.append((start, state))',
+        '        pos += 1',
+        '        partials = nextpartials',
+        '        if left < 0:',
+        '            if not partials and FIRST is not None:',
+        '                found = FIRST.search(text, pos)',
+        '                if found is None:',
+        '                    pos = n',
+        '                else:',
+        '                    pos = found.start()',
+        '            partials.append((pos, START))',
+        '        elif not partials:',
+        '            return left, right, regexp',
+        '    for start, state in partials:',
+        '        if left >= 0 and start > left:',
+        '            break',
+        '        found = FINALS[state]',
+        '        if found >= 0:',
+        '            left = start',
+        '            right = n',
+        '            regexp = found',
+        '    if left < 0:',
+        '        return None',
+        '    return left, right, regexp',
+    ])
+    return '\n'.join(lines) + '\n'
+
+def _matchIndex(match):
+    if match is None:
+        return None
+    return match.index()
+
 class ParseError(Exception):
     pass
 
@@ -746,7 +3605,75 @@ def escape(s):
         s = s.replace(ch, '\\' + ch)
     return s
 
+# Compile caches
+#
+# The parse tree of a regexp, and the required literals found in it,
+# are kept in process-wide caches keyed by the regexp text.  Both are
+# made of tuples, strings and frozensets, so they are shared by every
+# pattern using the regexp.  The nodes are still made for each pattern,
+# since they hold its Match index and value and its loop slots, and
+# are changed as regexps are added - making them costs less than
+# copying a cached graph would.
+
+SCAN_CACHE_SIZE = 1024      # most parse trees kept
+COMPILE_CACHE_SIZE = 1024   # most sets of required literals kept
+
+_missing = object()
+
+class CompileCache:
+
+    # A least recently used cache, counting hits and misses.
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        value = self.entries.get(key, _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def setMaxSize(self, maxsize):
+        # 0 turns the cache off
+        self.maxsize = maxsize
+        while len(self.entries) > max(maxsize, 0):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+scan_cache = CompileCache(SCAN_CACHE_SIZE)
+compile_cache = CompileCache(COMPILE_CACHE_SIZE)
+
 def scan(pattern):
+    # the parse tree of pattern, which is a tuple shared with any other
+    # caller scanning the same text
+    tree = scan_cache.get(pattern, _missing)
+    if tree is _missing:
+        tree = _scan(pattern)
+        scan_cache.put(pattern, tree)
+    return tree
+
+def _scan(pattern):
     tree = None
     stack = []
     bracket = 0
@@ -888,8 +3815,7 @@ def scan(pattern):
                 tree = None
             elif ch == ')':
                 if stack and stack[-1] and stack[-1][0] is CHOICE:
-                    stack[-1][1].append(tree)
-                    tree = stack.pop()
+                    tree = _choice(stack.pop(), tree)
                 if stack:
                     tree = (PAREN, tree, stack.pop())
                 else:
@@ -916,17 +3842,324 @@ def scan(pattern):
         raise ParseError('missing close bracket "]"')
     if stack:
         if stack[-1] and stack[-1][0] is CHOICE:
-            stack[-1][1].append(tree)
-            tree = stack.pop()
+            tree = _choice(stack.pop(), tree)
         if stack:
             raise ParseError('missing close parentheses ")"')
     return tree
 
+def _choice(choice, tree):
+    # close the open choice with its last alternative, freezing the
+    # alternatives so the cached tree holds no mutable parts
+    alternatives = choice[1]
+    alternatives.append(tree)
+    return (CHOICE, tuple(alternatives), None)
+
+def _byte(ch):
+    # the value of a character in a bytes regexp
+    i = ord(ch)
+    if i > 255:
+        raise ParseError('character %r is not a byte' % ch)
+    return i
+
+def _bracket(data):
+    # the CharacterSet, [:class:] names and complement flag of a bracket
+    # expression
+    intervals = []
+    classes = []
+    compl = 0
+    while data:
+        token, ch, data = data
+        if token is CHAR:
+            if data and data[0] is DASH:
+                # we have a range
+                data = data[2]
+                token, ch1, data = data
+                assert token is CHAR
+                if ch1 > ch:
+                    raise ValueError('brace lower limit greater '
+                                'than upper limit [%s-%s]'
+                                % (ch1, ch))
+                intervals.append((ch1, ch))
+            else:
+                intervals.append((ch, ch))
+        elif token is DASH:
+            intervals.append((ch, ch))
+        elif token is CLASS:
+            if ch == 'blank':
+                intervals.extend(((' ', ' '), ('\t', '\t')))
+            elif ch == 'digit':
+                intervals.append(('0', '9'))
+            elif ch == 'xdigit':
+                intervals.extend((('0', '9'), ('a', 'f'), ('A', 'F')))
+            else:
+                classes.append(ch)
+        else:
+            assert token is COMPLEMENT
+            assert not data
+            compl = 1
+    return CharacterSet(intervals), classes, compl
+
+# Saved patterns
+#
+# Pattern.dump() saves the node graph of a pattern as a header, then a
+# kind byte for each node, then the fields of the nodes as 32-bit ints
+# (node numbers, characters as code points, and function numbers), and
+# last a pickle of the match values and other Python objects.  load()
+# makes each node without calling its __init__, so none of the regexps
+# are scanned or compiled again.  The DFA and other caches are not
+# saved, and are built again when first needed.
+
+FORMAT_MAGIC = b'TRSP'
+FORMAT_VERSION = 3
+
+_FORMAT_HEADER = struct.Struct('<4sHHIII')
+
+# the kind of each node, with the class it is made from
+_NODE_CLASSES = [
+    Match,
+    ControlNode,
+    StartAnchorNode,
+    TagControlNode,
+    OptionalNode,
+    IterationExitNode,
+    IterationLoopNode,
+    TransitionNode,
+    EndAnchorNode,
+    CharacterNode,
+    ComplexCharacterComplement,
+    MutableCharacterMap,
+    CharacterMatchNode,
+    CharacterMatchNotNode,
+]
+
+_node_kinds = {}
+for _kind in range(len(_NODE_CLASSES)):
+    _node_kinds[_NODE_CLASSES[_kind]] = _kind
+
+# the functions which nodes may hold, saved by their number
+_FUNCTIONS = [Always, StartAnchor, EndAnchor]
+_names = list(_class_functions.keys())
+_names.sort()
+for _name in _names:
+    _FUNCTIONS.append(_class_functions[_name])
+for _name in _names:
+    _FUNCTIONS.append(_byte_class_functions[_name])
+
+_function_numbers = {}
+for _number in range(len(_FUNCTIONS)):
+    _function_numbers[_FUNCTIONS[_number]] = _number
+
+def _dumpGraph(pattern):
+    # the kinds, fields and values of the nodes of pattern
+    numbers = {}
+    nodes = []
+    def number(node):
+        n = numbers.get(id(node))
+        if n is None:
+            n = numbers[id(node)] = len(nodes)
+            nodes.append(node)
+        return n
+    ints = []
+    def links(nodes):
+        ints.append(len(nodes))
+        for node in nodes:
+            ints.append(number(node))
+    if pattern.binary:
+        code = int
+    else:
+        code = ord
+    ints.append(number(pattern.start0))
+    ints.append(number(pattern.start))
+    ints.append(len(pattern.regexps))
+    for regexp in range(len(pattern.regexps)):
+        links(pattern.regexps[regexp][0])
+        ints.append(number(pattern.matches[regexp]))
+    kinds = bytearray()
+    values = []
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        i += 1
+        kind = _node_kinds[node.__class__]
+        kinds.append(kind)
+        if kind == 0:
+            # Match
+            ints.append(node.index())
+            ints.append(len(values))
+            values.append(node.value())
+        elif kind in (1, 7, 9):
+            # a node with any function
+            ints.append(_function_numbers[node.func])
+            links(node.links)
+        elif kind in (2, 3, 8):
+            # a node with a fixed function, or none
+            links(node.links)
+        elif kind == 4:
+            ints.append(node.isgreedy)
+            links(node.opts)
+            links(node.links)
+        elif kind == 5:
+            ints.append(node.slot)
+            links(node.links)
+        elif kind == 6:
+            ints.append(node.slot)
+            ints.append(node.lower)
+            if node.upper is None:
+                ints.append(0)
+            else:
+                ints.append(node.upper + 1)
+            ints.append(number(node.exit))
+            ints.append(node.isgreedy)
+            links(node.links)
+        elif kind == 10:
+            # ComplexCharacterComplement
+            ints.append(len(node.characters.intervals))
+            for lo, hi in node.characters.intervals:
+                ints.append(code(lo))
+                ints.append(code(hi))
+            ints.append(len(node.funcs))
+            for func in node.funcs:
+                ints.append(_function_numbers[func])
+            links(node.links)
+        else:
+            # a character map, with the links of each interval
+            ints.append(len(node.starts))
+            for start, chlinks in zip(node.starts, node.segments):
+                ints.append(code(start))
+                links(chlinks)
+    return kinds, ints, values
+
+def _loadGraph(kinds, ints, values, binary):
+    # the start nodes, regexps and Match nodes saved by _dumpGraph
+    nodes = []
+    for kind in kinds:
+        cls = _NODE_CLASSES[kind]
+        nodes.append(cls.__new__(cls))
+    if binary:
+        char = int
+    else:
+        char = chr
+    getnode = nodes.__getitem__
+    shared = {}
+    i = 0
+    def links():
+        nonlocal i
+        n = ints[i]
+        i += n + 1
+        return list(map(getnode, ints[i - n:i]))
+    start0 = nodes[ints[0]]
+    start = nodes[ints[1]]
+    nregexps = ints[2]
+    i = 3
+    regexps = []
+    matches = []
+    for regexp in range(nregexps):
+        regexps.append(links())
+        matches.append(nodes[ints[i]])
+        i += 1
+    for node, kind in zip(nodes, kinds):
+        if kind == 0:
+            node._index = ints[i]
+            node._value = values[ints[i + 1]]
+            i += 2
+        elif kind in (1, 7, 9):
+            node.func = _FUNCTIONS[ints[i]]
+            i += 1
+            node.links = links()
+        elif kind in (2, 3, 8):
+            if kind == 2:
+                node.func = StartAnchor
+            elif kind == 8:
+                node.func = EndAnchor
+            node.links = links()
+        elif kind == 4:
+            node.isgreedy = ints[i]
+            i += 1
+            node.opts = links()
+            node.links = links()
+            node.both = None
+        elif kind == 5:
+            node.slot = ints[i]
+            i += 1
+            node.links = links()
+        elif kind == 6:
+            node.slot, node.lower, upper, exit, node.isgreedy = \
+                                                        ints[i:i + 5]
+            i += 5
+            if upper == 0:
+                node.upper = None
+            else:
+                node.upper = upper - 1
+            node.exit = nodes[exit]
+            node.links = links()
+            node.both = None
+        elif kind == 10:
+            n = ints[i]
+            codes = ints[i + 1:i + 2 * n + 1]
+            node.characters = CharacterSet(list(zip(map(char, codes[::2]),
+                                                    map(char, codes[1::2]))))
+            i += 2 * n + 1
+            n = ints[i]
+            node.funcs = [_FUNCTIONS[j] for j in ints[i + 1:i + n + 1]]
+            i += n + 1
+            node.links = links()
+        else:
+            n = ints[i]
+            i += 1
+            node.starts = []
+            node.segments = []
+            for j in range(n):
+                node.starts.append(char(ints[i]))
+                i += 1
+                chlinks = links()
+                if kind != 11:
+                    # the intervals of a match node share their links
+                    chlinks = tuple(chlinks)
+                    chlinks = shared.setdefault(chlinks, chlinks)
+                node.segments.append(chlinks)
+            if kind == 11:
+                # the map may be shared, so a change copies it
+                node.owner = None
+    assert i == len(ints), (i, len(ints))
+    return start0, start, regexps, matches
+
 class Pattern:
 
     def __init__(self, pattern=None, match=None):
+        # a writer for the parse tree and graph of each regexp added
         self.debug = None
+        # a Trace given to the Matchers made by the pattern, or None
+        self.trace = None
         self.seqno = 0
+        # 'lazy' uses a lazily built DFA, 'dfa' a DFA built in advance
+        # by compile(), 'bits' a BitNFA, and 'nfa' always walks the
+        # node graph
+        self.mode = 'lazy'
+        self.maxstates = None
+        self.fallback = 1
+        self.tagged = 0
+        # 1 if the regexps are bytes, 0 if str, or None until one is
+        # added - a bytes pattern matches bytes-like text
+        self.binary = None
+        self.dfa = None
+        self.first = 0
+        self.alphabet = None
+        self.reverse = None
+        self.scandfa = None
+        self.counted = None
+        self.closures = None
+        self.codegen = None
+        # (links, required literals, offset) for each regexp added
+        self.regexps = []
+        # the Match node and text of each regexp added
+        self.matches = []
+        self.sources = []
+        self.prefilter = 0
+        self.subpatterns = {}
+        # depth of batch() calls, and whether the start links must be
+        # made again when they end
+        self.batching = 0
+        self.relink = 0
         self.start0 = ControlNode(Always)
         self.start = ControlNode(Always)
         if pattern:
@@ -935,33 +4168,721 @@ class Pattern:
     def clone(self):
         pat = Pattern()
         pat.debug = self.debug
+        pat.trace = self.trace
         pat.seqno = self.seqno
+        pat.mode = self.mode
+        pat.maxstates = self.maxstates
+        pat.fallback = self.fallback
+        pat.tagged = self.tagged
+        pat.binary = self.binary
+        pat.regexps = self.regexps[:]
+        pat.matches = self.matches[:]
+        pat.sources = self.sources[:]
         pat.start0.addLinks(self.start0.getAllLinks())
         pat.start.addLinks(self.start.getAllLinks())
         return pat
 
+    def to_python(self, name='match'):
+        # Return the source of a Python module defining a function
+        # name(text), which returns the (start, end, regexp) of the
+        # match that match() finds in text, or None, where regexp is
+        # the number of the regexp in the order they were added.  The
+        # function steps the full DFA from tables in the source, so
+        # the module can be saved and imported without compiling the
+        # regexps.  Raises StateLimitExceeded if the pattern uses tags
+        # or its DFA has more than maxstates states.
+        dfa = self.dfa
+        if not isinstance(dfa, FullDFA):
+            dfa = FullDFA(self, self.maxstates)
+        return _pythonSource(self, dfa, name)
+
+    def compile_codegen(self):
+        # Return a function like match(), which runs the code from
+        # to_python.  The function is kept until the regexps change.
+        if self.codegen is None:
+            namespace = {}
+            exec(compile(self.to_python(), '<Trespass codegen>', 'exec'),
+                                                                namespace)
+            search = namespace['match']
+            values = [match.value() for match in self.matches]
+            def match(text):
+                found = search(text)
+                if found is None:
+                    return None
+                start, end, regexp = found
+                return MatchObject(start, end, None, values[regexp])
+            self.codegen = match
+        return self.codegen
+
+    def dump(self):
+        # Return the pattern saved as bytes, which load() makes into a
+        # Pattern again.  The match values are pickled, so only load
+        # data from a trusted source.
+        kinds, ints, values = _dumpGraph(self)
+        ints = array.array('I', ints)
+        if sys.byteorder == 'big':
+            ints.byteswap()
+        flags = 0
+        if self.binary is not None:
+            flags = 1 | self.binary << 1
+        if self.tagged:
+            flags |= 4
+        extra = pickle.dumps((values,
+                    [(required, offset, source)
+                        for (links, required, offset), source
+                                    in zip(self.regexps, self.sources)],
+                    self.mode, self.maxstates, self.fallback), 4)
+        header = _FORMAT_HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, flags,
+                                    self.seqno, len(kinds), len(ints))
+        return b''.join([header, kinds, ints.tobytes(), extra])
+
+    @staticmethod
+    def load(data):
+        # Return the Pattern saved by dump() as data, which may be any
+        # bytes-like object, such as an mmap of a file.
+        data = memoryview(data)
+        if len(data) < _FORMAT_HEADER.size:
+            raise ValueError('not a saved pattern')
+        magic, version, flags, seqno, nnodes, nints = \
+                                    _FORMAT_HEADER.unpack_from(data)
+        if magic != FORMAT_MAGIC:
+            raise ValueError('not a saved pattern')
+        if version != FORMAT_VERSION:
+            raise ValueError('unsupported pattern format %d' % version)
+        offset = _FORMAT_HEADER.size
+        kinds = bytes(data[offset:offset + nnodes])
+        offset += nnodes
+        ints = array.array('I')
+        ints.frombytes(data[offset:offset + 4 * nints])
+        if sys.byteorder == 'big':
+            ints.byteswap()
+        offset += 4 * nints
+        values, literals, mode, maxstates, fallback = pickle.loads(
+                                                        data[offset:])
+        pat = Pattern()
+        if flags & 1:
+            pat.binary = flags >> 1 & 1
+        pat.tagged = flags >> 2 & 1
+        pat.seqno = seqno
+        pat.mode = mode
+        pat.maxstates = maxstates
+        pat.fallback = fallback
+        pat.start0, pat.start, regexps, pat.matches = _loadGraph(
+                                kinds, ints.tolist(), values, pat.binary)
+        for links, (required, offset, source) in zip(regexps, literals):
+            pat.regexps.append((links, required, offset))
+            pat.sources.append(source)
+        return pat
+
+    def __reduce__(self):
+        return Pattern.load, (self.dump(),)
+
     def addRegExp(self, pattern, match=None):
+        # Add the regexp pattern, with match as the value of its matches.
+        # Returns a handle for removeRegExp.
+        if isinstance(pattern, str):
+            binary = 0
+        else:
+            # scan each byte as the character with the same value
+            binary = 1
+            pattern = bytes(pattern).decode('latin-1')
+        if self.binary is None:
+            self.binary = binary
+        elif binary != self.binary:
+            raise TypeError('cannot mix str and bytes regular expressions')
         stack = scan(pattern)
         if self.debug:
             self.debug('%s\n' % (stack,))
         links = self._compile(stack, match)
+        self.sources.append(pattern)
+        literals = compile_cache.get(pattern)
+        if literals is None:
+            exact, prefix, required, offset, maxlen = _literals(stack)
+            literals = (required, offset)
+            compile_cache.put(pattern, literals)
+        required, offset = literals
+        self.regexps.append((links, required, offset))
+        self._invalidate()
+        if self.prefilter is None:
+            # there may now be enough regexps for one
+            self.prefilter = 0
+        elif self.prefilter and not self.prefilter.add(
+                            len(self.regexps) - 1, required, offset):
+            self.prefilter = 0
+        # the cached sub-patterns do not include the new regexp, which
+        # is only enabled under a new key
+        if not self.relink:
+            self._addLinks(links)
+        if self.debug:
+            print_graph(self.debug, [self.start0])
+        return self.matches[-1]
+
+    def removeRegExp(self, handle):
+        # Remove the regexp whose handle was returned by addRegExp.  The
+        # start links are made again from the other regexps (at the end
+        # of the batch, inside batch()), so a Matcher already made keeps
+        # matching the old regexps.
+        for regexp in range(len(self.matches)):
+            if self.matches[regexp] is handle:
+                break
+        else:
+            raise ValueError('regexp is not in the pattern')
+        del self.regexps[regexp]
+        del self.matches[regexp]
+        del self.sources[regexp]
+        self._invalidate()
+        if self.prefilter:
+            if len(self.regexps) < PREFILTER_MINIMUM:
+                self.prefilter = 0
+            else:
+                self.prefilter.remove(regexp, self.regexps)
+        # sub-patterns without the regexp are still valid, with the
+        # regexps after it numbered one lower
+        subpatterns = {}
+        for key, pat in self.subpatterns.items():
+            if regexp not in key:
+                subpatterns[tuple([n - (n > regexp) for n in key])] = pat
+        self.subpatterns = subpatterns
+        self.relink = 1
+        if not self.batching:
+            self._relink()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Group calls to addRegExp and removeRegExp, so the start links
+        # are made again once, at the end of the outermost batch.
+        self.batching += 1
+        try:
+            yield self
+        finally:
+            self.batching -= 1
+            if not self.batching and self.relink:
+                self._relink()
+
+    def _relink(self):
+        self.start0 = ControlNode(Always)
+        self.start = ControlNode(Always)
+        for links, required, offset in self.regexps:
+            self._addLinks(links)
+        self.relink = 0
+        self._invalidate()
+
+    def _invalidate(self):
+        # drop everything built from the regexps, after they change
+        self.dfa = None
+        self.first = 0
+        self.alphabet = None
+        self.reverse = None
+        self.scandfa = None
+        self.counted = None
+        self.closures = None
+        self.codegen = None
+
+    def _addLinks(self, links):
         for link in links:
             if isinstance(link, StartAnchorNode):
                 self.start0.addLinks(link.getAllLinks())
             else:
                 self.start.addLink(link)
                 self.start0.addLink(link)
-        if self.debug:
-            print_graph(self.debug, [self.start0])
+
+    def compile(self, mode='dfa', maxstates=None, fallback=1):
+        # Set the engine used to match this pattern. For 'dfa', the
+        # whole DFA is built now, unless it needs more than maxstates
+        # states or the pattern uses tags, in which case the lazy DFA
+        # is used if fallback is true, or StateLimitExceeded raised.
+        # Likewise for 'bits', if the pattern uses tags or has more
+        # than BITS_MAX_POSITIONS positions.  Returns the DFA, which
+        # for a full DFA reports nstates (after minimization), nbuilt
+        # (before) and nclasses, and a BitNFA npositions, or None if
+        # the graph is walked.
+        if mode not in ('dfa', 'lazy', 'nfa', 'bits'):
+            raise ValueError('unknown mode %r' % (mode,))
+        self.mode = mode
+        self.maxstates = maxstates
+        self.fallback = fallback
+        self.dfa = None
+        self.subpatterns = {}
+        return self.getDFA()
+
+    def getDFA(self):
+        # Return the DFA for this pattern, or None if the node graph
+        # is to be walked.
+        if self.mode == 'nfa':
+            return None
+        if self.dfa is None:
+            if self.mode == 'dfa':
+                try:
+                    self.dfa = FullDFA(self, self.maxstates)
+                except StateLimitExceeded:
+                    if not self.fallback:
+                        raise
+            elif self.mode == 'bits':
+                try:
+                    self.dfa = BitNFA(self)
+                except StateLimitExceeded:
+                    if not self.fallback:
+                        raise
+            if self.dfa is None:
+                self.dfa = LazyDFA(self, self.tagged, self.maxstates)
+        elif self.dfa.__class__ is LazyDFA and self.dfa.flushes:
+            # the cache has overflowed, so use a BitNFA if there is
+            # one, or else walk the graph if counting sets keep the
+            # threads of its large counted loops
+            bits = self.dfa.getBits()
+            if bits is not None:
+                self.dfa = bits
+            elif self.isCounted():
+                return None
+        return self.dfa
+
+    def isCounted(self):
+        # Return true if the pattern has no tags, and a loop counting
+        # COUNTING_MINIMUM or more characters, which counting sets
+        # match in the same time for any bound.
+        if self.counted is None:
+            self.counted = 0
+            if not self.tagged:
+                for node in _reachable([self.start0, self.start]):
+                    if (
+                        node.__class__ is IterationLoopNode and
+                        max(node.lower, node.upper or 0) >=
+                                                COUNTING_MINIMUM and
+                        node.getBody()
+                    ):
+                        self.counted = 1
+                        break
+        return self.counted
+
+    def getClosures(self):
+        # Return the epsilon closure of each node of the graph, which
+        # the Matcher follows instead of the option, tag and loop exit
+        # nodes when it walks the graph.
+        if self.closures is None:
+            self.closures = _epsilonClosures(
+                                _reachable([self.start0, self.start]))
+        return self.closures
+
+    def getAlphabet(self):
+        # Return the Alphabet of character classes for the pattern.
+        if self.alphabet is None:
+            charnodes = [node for node in
+                            _reachable([self.start0, self.start])
+                                        if node.type is TYPE_CHARACTER]
+            self.alphabet = Alphabet(charnodes, self.binary)
+        return self.alphabet
+
+    def getReverse(self):
+        # Return a Pattern whose regexps match the reverse of the texts
+        # matched by the regexps of this pattern, in the same order.
+        # The reversed regexps have no tags, and no match values.
+        if self.reverse is None:
+            pat = Pattern()
+            pat.binary = self.binary
+            pat.maxstates = self.maxstates
+            for source in self.sources:
+                links = pat._compile(_reverseTree(scan(source)), None)
+                pat.regexps.append((links, None, None))
+                pat._addLinks(links)
+            self.reverse = pat
+        return self.reverse
+
+    def _getScanDFA(self):
+        if self.scandfa is None:
+            self.scandfa = ScanDFA(self)
+        return self.scandfa
+
+    def getFirstCharacters(self):
+        # Return the FirstCharacters which can start an unanchored
+        # match, or None if it cannot be determined.
+        if self.first == 0:
+            self.first = _firstCharacters(self.start, self.binary)
+        return self.first
+
+    def getPrefilter(self):
+        # Return the Prefilter for the required literals of the
+        # regexps, or None if there are too few regexps to need one.
+        if self.prefilter == 0:
+            self.prefilter = None
+            if len(self.regexps) >= PREFILTER_MINIMUM:
+                for links, required, offset in self.regexps:
+                    if required is not None:
+                        self.prefilter = Prefilter(self.regexps,
+                                                            self.binary)
+                        break
+        return self.prefilter
+
+    def _getSubPattern(self, enabled):
+        # a pattern matching only the enabled regexps, which keep their
+        # Match nodes and so their priorities
+        key = list(enabled.keys())
+        key.sort()
+        key = tuple(key)
+        pat = self.subpatterns.get(key)
+        if pat is None:
+            if len(self.subpatterns) >= SUBPATTERN_LIMIT:
+                self.subpatterns = {}
+            pat = Pattern()
+            pat.debug = self.debug
+            pat.mode = self.mode
+            pat.maxstates = self.maxstates
+            pat.fallback = self.fallback
+            pat.tagged = self.tagged
+            pat.binary = self.binary
+            pat.prefilter = None
+            for regexp in key:
+                pat._addLinks(self.regexps[regexp][0])
+            self.subpatterns[key] = pat
+        return pat
+
+    def _getTextPattern(self, text):
+        # the pattern to search the whole of text with, or None if
+        # there can be no match
+        pattern = self
+        prefilter = self.getPrefilter()
+        if prefilter is not None:
+            # only the regexps whose required literals are in the text
+            # can match it
+            enabled = prefilter.enabled(text)
+            if not enabled:
+                return None
+            if len(enabled) < len(self.regexps) and not self.tagged:
+                # tags depend on the order in which the start links
+                # were merged, so are only kept by the whole pattern
+                pattern = self._getSubPattern(enabled)
+                # its Matchers count in the Trace of this pattern
+                pattern.trace = self.trace
+        return pattern
 
     def match(self, text):
+        pattern = self._getTextPattern(text)
+        if pattern is None:
+            return None
+        matcher = Matcher(pattern)
+        return matcher.addFinal(text)
+
+    def prefixmatch(self, text):
+        # Return a MatchObject for the match starting at the start of
+        # text, chosen as by match(), or None.  Only threads from the
+        # start of the text are followed, so no more of the text is
+        # read once none are left.
         matcher = Matcher(self)
-        matcher.debug = self.debug
+        matcher.anchored = 1
         return matcher.addFinal(text)
 
+    def fullmatch(self, text):
+        # Return a MatchObject if the whole of text matches, or None.
+        # The match chosen at the start of text is the longest, so it
+        # is the whole text if any regexp matches it.
+        match = self.prefixmatch(text)
+        if match is None or match.end() != len(text):
+            return None
+        return match
+
+    def search_any(self, text):
+        # Return a MatchObject for the first match to end in text, or
+        # None.  Matches ending at the same position are chosen as by
+        # match(), but the search stops as soon as one is found, so
+        # the match may not be the leftmost or longest.
+        pattern = self._getTextPattern(text)
+        if pattern is None:
+            return None
+        matcher = Matcher(pattern)
+        matcher.earliest = 1
+        return matcher.addFinal(text)
+
+    def search_reverse(self, text):
+        # Return the MatchObject that match() returns for text, found
+        # without a partial for each start position.  A forward pass
+        # finds the end of the first match to end, and the furthest end
+        # of a match starting no later.  A reverse pass from there over
+        # the reversed regexps finds the leftmost start, and only the
+        # match from that start is followed to find its end and tags.
+        # An unbounded regexp can make either pass read to the end of
+        # text, so this is only faster where matches are short.
+        if self._getTextPattern(text) is None:
+            return None
+        n = len(text)
+        scan = self._getScanDFA()
+        alphabet = scan.alphabet
+        classmap = alphabet.map
+        first = self.getFirstCharacters()
+        initial = scan.dfa.initial
+        state = scan.dfa.initial0
+        i = 0
+        firstend = lastend = None
+        while state is not None:
+            if i == n:
+                accept = state.getFinal()[0]
+            else:
+                accept = state.accept
+            if accept is not None:
+                if firstend is None:
+                    firstend = i
+                lastend = i
+            if i == n:
+                break
+            if state is initial and first is not None:
+                i = first.find(text, i)
+                if i == n:
+                    # no match can start before the end
+                    continue
+            ch = text[i]
+            i += 1
+            cls = classmap.get(ch)
+            if cls is None:
+                cls = alphabet.getClass(ch)
+            state = scan.step(state, cls, firstend is None)
+        if firstend is None:
+            return None
+        scan = self.getReverse()._getScanDFA()
+        alphabet = scan.alphabet
+        classmap = alphabet.map
+        if lastend == n:
+            state = scan.dfa.initial0
+        else:
+            state = scan.dfa.initial
+        j = lastend
+        start = None
+        while state is not None:
+            if j == 0:
+                if state.getFinal()[0] is not None:
+                    start = 0
+                break
+            if state.accept is not None:
+                start = j
+            j -= 1
+            ch = text[j]
+            cls = classmap.get(ch)
+            if cls is None:
+                cls = alphabet.getClass(ch)
+            # a match ending at j may start further left
+            state = scan.step(state, cls, j >= firstend)
+        matcher = Matcher(self)
+        matcher.anchored = 1
+        if start > 0:
+            matcher.reset(start, text[start - 1])
+        return matcher._addFinal(text, start)
+
+    def match_many(self, texts):
+        # Search each of a sequence of texts, as match() does. Returns
+        # numpy arrays of the start and end of the match in each text,
+        # and of the number of the regexp matched, counting from 0 in
+        # the order added, all -1 where there is no match, and a numpy
+        # array of the value of each regexp, so values[index[i]] is
+        # the value matched in texts[i].  With compile('dfa'), all the
+        # texts are stepped through the DFA together, which is much
+        # faster than calling match() for many short texts.
+        if numpy is None:
+            raise ImportError('match_many needs numpy')
+        values = numpy.empty(len(self.matches), dtype=object)
+        numbers = {}
+        for number in range(len(self.matches)):
+            match = self.matches[number]
+            values[number] = match.value()
+            numbers[match] = number
+        dfa = self.getDFA()
+        if isinstance(dfa, FullDFA):
+            starts, ends, codes, matches = dfa.matchMany(texts)
+            table = numpy.array([numbers[match] for match in matches] +
+                                    [-1], dtype=numpy.intp)
+            # code -1 picks the last entry of table
+            return starts, ends, table[codes], values
+        # the DFA could not be built in advance, so match each text
+        n = len(texts)
+        starts = numpy.full(n, -1, dtype=numpy.intp)
+        ends = numpy.full(n, -1, dtype=numpy.intp)
+        indexes = numpy.full(n, -1, dtype=numpy.intp)
+        for i in range(n):
+            pattern = self._getTextPattern(texts[i])
+            if pattern is None:
+                continue
+            matcher = Matcher(pattern)
+            match = matcher.addFinal(texts[i])
+            if match is not None:
+                starts[i] = match.start()
+                ends[i] = match.end()
+                indexes[i] = numbers[matcher.match]
+        return starts, ends, indexes, values
+
+    def finditer(self, text, pos=0):
+        # Generate a MatchObject for each match in text, starting at
+        # index pos.  Each search starts where the last match ended
+        # (or one character later, for an empty match), and positions
+        # are indexes into text.
+        pattern = self._getTextPattern(text)
+        if pattern is None:
+            return
+        matcher = Matcher(pattern)
+        n = len(text)
+        while pos <= n:
+            if pos == 0:
+                matcher.reset()
+            else:
+                matcher.reset(pos, text[pos - 1])
+            match = matcher._addFinal(text, pos)
+            if match is None:
+                return
+            yield match
+            pos = match.end()
+            if match.start() == pos:
+                pos += 1
+
+    def search_parallel(self, source, workers=None, segment=None):
+        # Return a list of the matches in a text, the same as
+        # list(finditer(text)), using a pool of worker processes which
+        # each search a segment of the text.  source is the text, or an
+        # os.PathLike naming a file with the text for a bytes pattern.
+        # segment is the length of text given to each worker, by
+        # default split evenly between the workers.
+        path = None
+        if isinstance(source, os.PathLike):
+            if not self.binary:
+                raise TypeError('a file can only be searched by a '
+                                    'bytes pattern')
+            path = os.fspath(source)
+            f = open(path, 'rb')
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    text = b''
+                else:
+                    text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            if text:
+                # close the mmap of the file once searched
+                try:
+                    return self._searchParallel(text, path, workers,
+                                                                segment)
+                finally:
+                    text.close()
+        else:
+            text = source
+        return self._searchParallel(text, path, workers, segment)
+
+    def _searchParallel(self, text, path, workers, segment):
+        n = len(text)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if segment is None:
+            segment = max(-(-n // workers), PARALLEL_SEGMENT_MINIMUM)
+        begins = list(range(0, n, segment)) or [0]
+        if workers == 1 or len(begins) == 1:
+            return list(self.finditer(text))
+        ends = begins[1:] + [n]
+        tasks = []
+        for begin, end in zip(begins, ends):
+            if path is None:
+                task = text[max(begin - 1, 0):end]
+            else:
+                task = None
+            tasks.append((path, task, begin, end, end == n))
+        with concurrent.futures.ProcessPoolExecutor(workers,
+                        initializer=_initWorker, initargs=(self,)) as pool:
+            results = list(pool.map(_searchSegment, *zip(*tasks)))
+        resumes = [[link[0] for link in chain] for chain, resume, earliest
+                                                            in results]
+
+        def resumable(pos):
+            # whether the worker results give the search from pos
+            k = bisect.bisect_right(begins, pos) - 1
+            chain, resume, earliest = results[k]
+            i = bisect.bisect_right(resumes[k], pos) - 1
+            return (i >= 0 and chain[i][1] >= pos or
+                                                resume <= pos < earliest)
+
+        # follow the sequential search through the segments, searching
+        # here only where it is not where a worker searched from
+        matches = []
+        matcher = None
+        pos = 0
+        k = 0
+        while pos <= n:
+            while k + 1 < len(begins) and begins[k + 1] <= pos:
+                k += 1
+            chain, resume, earliest = results[k]
+            # the last worker search from at or before pos
+            i = bisect.bisect_right(resumes[k], pos) - 1
+            if i >= 0 and (resumes[k][i] == pos or chain[i][1] >= pos):
+                # it found the match this search would find, and from
+                # there both searches are the same
+                for q, start, end, tags, value in chain[i:]:
+                    matches.append(MatchObject(start, end, tags, value))
+                pos = resume
+                continue
+            if resume <= pos < earliest:
+                # no match starts before the earliest unfinished search
+                pos = earliest
+                continue
+            if matcher is None:
+                matcher = Matcher(self)
+            if pos == 0:
+                matcher.reset()
+            else:
+                matcher.reset(pos, text[pos - 1])
+            # search here only until no match can start before a
+            # position from where the worker results apply again
+            match = None
+            handover = None
+            while matcher.currpos < n:
+                stop = min(matcher.currpos + PARALLEL_RESCAN_STEP, n)
+                match = matcher._addChunk(text[matcher.currpos:stop], 0)
+                if match is not None:
+                    break
+                first = stop
+                if matcher.partials:
+                    first = min(first, matcher.partials[0][0])
+                if matcher.match is not None:
+                    first = min(first, matcher.matchleft)
+                if first > pos and resumable(first):
+                    handover = first
+                    break
+            else:
+                match = matcher._addFinal(text, n)
+            if match is None:
+                if handover is None:
+                    break
+                pos = handover
+                continue
+            matches.append(match)
+            pos = match.end()
+            if match.start() == pos:
+                pos += 1
+        return matches
+
+    def stream(self, chunks):
+        # Generate a MatchObject for each match in the text made by an
+        # iterable of chunks, as for finditer, with positions in the
+        # whole text.
+        matcher = StreamMatcher(self)
+        for chunk in chunks:
+            for match in matcher.addChunk(chunk):
+                yield match
+        for match in matcher.addFinal():
+            yield match
+
+    def findall(self, text, pos=0):
+        # the text of each match, as for finditer
+        return [text[match.start():match.end()]
+                        for match in self.finditer(text, pos)]
+
+    def split(self, text, maxsplit=0):
+        # the text between matches - if maxsplit is not zero, at most
+        # maxsplit matches are used
+        pieces = []
+        last = 0
+        for match in self.finditer(text):
+            if maxsplit and len(pieces) >= maxsplit:
+                break
+            pieces.append(text[last:match.start()])
+            last = match.end()
+        pieces.append(text[last:])
+        return pieces
+
     def _compile(self, tree, match):
         seqno = self.seqno
         links = [Match(seqno, match)]
+        self.matches.append(links[0])
         self.seqno = seqno + 1
         links = self._comp(tree, links)
         return links
@@ -1012,9 +4933,8 @@ class Pattern:
                     assert upper is None or upper > 1
                     seqno = self.seqno
                     self.seqno = seqno + 1
-                    name = 'count%d' % seqno
-                    exit = IterationExitNode(name, links)
-                    loop = IterationLoopNode(name, lower, upper,
+                    exit = IterationExitNode(seqno, links)
+                    loop = IterationLoopNode(seqno, lower, upper,
                                                         exit, isgreedy)
                     links = self._getatom(token, data, [loop])
                     loop.addLinks(links)
@@ -1051,6 +4971,7 @@ class Pattern:
                     new.extend(self._comp(t, links))
                 links = new
             elif token is HASH:
+                self.tagged = 1
                 links = [TagControlNode(links)]
             else:
                 links = self._getatom(token, data, links)
@@ -1061,49 +4982,21 @@ class Pattern:
     # caller, a copy should be passed
     def _getatom(self, token, data, links):
         if token is CHAR:
-            links = [CharacterMatchNode(data, links)]
+            if self.binary:
+                data = _byte(data)
+            links = [CharacterMatchNode(CharacterSet([(data, data)]), links)]
         elif token is BRACKET:
-            characters = []
-            classes = []
-            compl = 0
-            while data:
-                token, ch, data = data
-                if token is CHAR:
-                    if data and data[0] is DASH:
-                        # we have a range
-                        upper = ord(ch)
-                        data = data[2]
-                        token, ch1, data = data
-                        assert token is CHAR
-                        i = ord(ch1)
-                        if i > upper:
-                            raise ValueError('brace lower limit greater '
-                                        'than upper limit [%s-%s]'
-                                        % (ch1, ch))
-                        while i <= upper:
-                            characters.append(chr(i))
-                            i += 1
-                    else:
-                        characters.append(ch)
-                elif token is DASH:
-                    characters.append(ch)
-                elif token is CLASS:
-                    if ch == 'blank':
-                        characters.extend(' \t')
-                    elif ch == 'digit':
-                        characters.extend('0123456789')
-                    elif ch == 'xdigit':
-                        characters.extend('0123456789abcdefABCDEF')
-                    else:
-                        classes.append(ch)
-                else:
-                    assert token is COMPLEMENT
-                    assert not data
-                    compl = 1
+            characters, classes, compl = _bracket(data)
+            if self.binary:
+                characters = CharacterSet([(_byte(lo), _byte(hi))
+                                for lo, hi in characters.intervals])
+                functions = _byte_class_functions
+            else:
+                functions = _class_functions
             if compl:
                 if classes:
                     links = [ComplexCharacterComplement(
-                                characters, classes, links)]
+                                characters, classes, links, functions)]
                 elif characters:
                     links = [CharacterMatchNotNode(characters, links)]
                 else:
@@ -1113,7 +5006,7 @@ class Pattern:
                 if characters:
                     nlinks.append(CharacterMatchNode(characters, links))
                 for c in classes:
-                    func = _class_functions[c]
+                    func = functions[c]
                     nlinks.append(CharacterNode(func, links))
                 if nlinks:
                     links = nlinks
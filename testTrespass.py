@@ -1,5 +1,9 @@
 
+import os
+import pathlib
+import pickle
 import sys
+import tempfile
 import unittest
 
 import Trespass
@@ -277,19 +281,28 @@ class RE10TestCase(unittest.TestCase):
         assert match.value() == 5
 
 # In PCRE, this is documented as taking exponential time
-# It does for us too
-#class RE11TestCase(unittest.TestCase):
+# It used to for us too, until threads reaching the same node were
+# merged
+class RE11TestCase(unittest.TestCase):
 
-#    def setUp(self):
-#        pat = Trespass.Pattern()
-#        #pat.debug = sys.stderr.write
-#        pat.addRegExp(r'([^[:digit:]]+|<[[:digit:]]+>)*[!?]', 5)
-#        self.matcher = Trespass.Matcher(pat)
+    def setUp(self):
+        pat = Trespass.Pattern()
+        #pat.debug = sys.stderr.write
+        pat.addRegExp(r'([^[:digit:]]+|<[[:digit:]]+>)*[!?]', 5)
+        self.pat = pat
+
+    def test1(self):
+        self.pat.mode = 'nfa'
+        matcher = Trespass.Matcher(self.pat)
+        match = matcher.addChunk('aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa')
+        assert match is None, repr(match)
+        match = matcher.addFinal('!')
+        assert ((match.start(), match.end()), match.value()) == ((0, 53), 5), repr(match)
 
-#    def test1(self):
-#        match = self.matcher.addChunk('aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa')
-#        #match = self.matcher.addChunk('aaaaaaaaaaaaa')
-#        assert match is None, repr(match)
+    def test2(self):
+        matcher = Trespass.Matcher(self.pat)
+        match = matcher.addChunk('aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa')
+        assert match is None, repr(match)
 
 class RE12TestCase(unittest.TestCase):
 
@@ -439,6 +452,1214 @@ class RE20TestCase(unittest.TestCase):
         match = self.matcher.addFinal('abcd')
         assert ((match.start(), match.end()), match.value()) == ((1, 3), 7), repr(match)
 
+class DFA1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(ab+c*)', 1)
+        pat.addRegExp(r'bf(ab+)*', 2)
+        pat.addRegExp(r'^(a(bc)?)*$', 3)
+        pat.addRegExp(r'01x?(ab+)*2', 'red')
+        self.pat = pat
+
+    def test1(self):
+        matcher = Trespass.Matcher(self.pat)
+        assert matcher.dfa is not None
+        match = matcher.addFinal('abbbabf')
+        assert ((match.start(), match.end()), match.value()) == ((0, 4), 1), repr(match)
+
+    def test2(self):
+        # states are reused on later passes over the same text
+        dfa = self.pat.getDFA()
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+        nstates = len(dfa.states)
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+        assert len(dfa.states) == nstates
+
+    def test3(self):
+        # a full cache is flushed without affecting the result
+        dfa = self.pat.getDFA()
+        dfa.maxstates = 2
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+        assert dfa.flushes > 0
+        assert len(dfa.states) <= 2
+
+    def test4(self):
+        self.pat.mode = 'nfa'
+        matcher = Trespass.Matcher(self.pat)
+        assert matcher.dfa is None
+        match = matcher.addFinal('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+
+    def test5(self):
+        # adding a pattern discards the DFA built for the old graph
+        self.pat.match('abc')
+        self.pat.addRegExp(r'ddg', 4)
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((0, 3), 4), repr(match)
+
+class DFA2TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'hello$', 4)
+        pat.addRegExp(r'(a{2,3})+b', 5)
+        self.matcher = Trespass.Matcher(pat)
+
+    def test1(self):
+        match = self.matcher.addChunk('hello, world')
+        assert match is None, repr(match)
+        match = self.matcher.addChunk('hello')
+        assert match is None, repr(match)
+        match = self.matcher.addFinal('')
+        assert ((match.start(), match.end()), match.value()) == ((12, 17), 4), repr(match)
+
+    def test2(self):
+        match = self.matcher.addChunk('aaaaa')
+        assert match is None, repr(match)
+        match = self.matcher.addChunk('aab')
+        assert ((match.start(), match.end()), match.value()) == ((0, 8), 5), repr(match)
+
+    def test3(self):
+        match = self.matcher.addFinal('abaab')
+        assert ((match.start(), match.end()), match.value()) == ((2, 5), 5), repr(match)
+
+class DFA3TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'([[:space:]]+#[[:alnum:]]+#)+!', 1)
+        pat.addRegExp(r'a{2,4}?#a??#a?#a*#a+#', 2)
+        self.pat = pat
+
+    def test1(self):
+        matcher = Trespass.Matcher(self.pat)
+        assert matcher.dfa.tagged
+        match = matcher.addFinal('!\t\thello world!')
+        assert match.start() == 1
+        assert match.end() == 15
+        assert match.tags() == (3, 8, 9, 14)
+        assert match.value() == 1
+
+    def test2(self):
+        match = self.pat.match('aaaaaaaa')
+        assert match.tags() == (2, 2, 3, 7, 8)
+        assert match.value() == 2
+
+    def test3(self):
+        # tags agree with the node graph walk
+        nfa = self.pat.clone()
+        nfa.mode = 'nfa'
+        for text in ('aaa', ' x!', 'b  ab aaaa!', '\tx\ty!a'):
+            match = self.pat.match(text)
+            expected = nfa.match(text)
+            assert (match.start(), match.end(), match.tags(),
+                    match.value()) == (expected.start(), expected.end(),
+                    expected.tags(), expected.value()), repr(text)
+
+class DFA4TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(x#)*', 5)
+        self.matcher = Trespass.Matcher(pat)
+
+    def test1(self):
+        # registers share the tags already recorded
+        match = self.matcher.addChunk('x' * 2000)
+        assert match is None
+        match = self.matcher.addFinal('y')
+        assert match.start() == 0
+        assert match.end() == 2000
+        assert match.tags() == tuple(range(1, 2001))
+
+class DFA5TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(ab+c*)', 1)
+        pat.addRegExp(r'bf(ab+)*', 2)
+        pat.addRegExp(r'^(a(bc)?)*$', 3)
+        pat.addRegExp(r'01x?(ab+)*2', 'red')
+        pat.addRegExp(r'x[[:digit:]]|y[^[:alpha:]q]', 'class')
+        self.pat = pat
+
+    def test1(self):
+        dfa = self.pat.compile('dfa')
+        assert isinstance(dfa, Trespass.FullDFA)
+        assert 0 < dfa.nstates <= dfa.nbuilt
+        assert len(dfa.trans) == dfa.nstates * dfa.nclasses
+        match = self.pat.match('abbbabf')
+        assert ((match.start(), match.end()), match.value()) == ((0, 4), 1), repr(match)
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+        match = self.pat.match('abcabc')
+        assert ((match.start(), match.end()), match.value()) == ((0, 6), 3), repr(match)
+        match = self.pat.match('xayqy!')
+        assert ((match.start(), match.end()), match.value()) == ((4, 6), 'class'), repr(match)
+        # [:digit:] is only 0-9, but U+0663 is not alphabetic
+        match = self.pat.match('y\u00e9x\u0663y\u0663')
+        assert ((match.start(), match.end()), match.value()) == ((4, 6), 'class'), repr(match)
+
+    def test2(self):
+        # states with the same future are merged
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'xab|xcb', 1)
+        dfa = pat.compile('dfa')
+        assert dfa.nstates < dfa.nbuilt, (dfa.nstates, dfa.nbuilt)
+
+    def test3(self):
+        self.assertRaises(Trespass.StateLimitExceeded,
+                        self.pat.compile, 'dfa', 5, 0)
+        dfa = self.pat.compile('dfa', 5)
+        assert isinstance(dfa, Trespass.LazyDFA)
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+
+    def test4(self):
+        self.pat.compile('dfa')
+        matcher = Trespass.Matcher(self.pat)
+        match = matcher.addChunk('ab')
+        assert match is None, repr(match)
+        match = matcher.addChunk('bcc')
+        assert match is None, repr(match)
+        match = matcher.addChunk('z')
+        assert ((match.start(), match.end()), match.value()) == ((0, 5), 1), repr(match)
+
+    def test5(self):
+        # tagged patterns use the lazy DFA
+        pat = Trespass.Pattern(r'a+#a+?', 7)
+        dfa = pat.compile('dfa')
+        assert isinstance(dfa, Trespass.LazyDFA) and dfa.tagged
+        assert pat.match('aaab').tags() == (2,)
+
+class NFA1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.mode = 'nfa'
+        pat.addRegExp(r'(a|ab)(c|bcd)#(d*)', 1)
+        pat.addRegExp(r'x*#x*#y', 2)
+        self.matcher = Trespass.Matcher(pat)
+
+    def test1(self):
+        # overlapping starts are all searched at once
+        match = self.matcher.addChunk('xxxxxxxxxxxxxxxx')
+        assert match is None, repr(match)
+        assert len(self.matcher.partials) <= 4, self.matcher.partials
+        match = self.matcher.addFinal('y')
+        assert match.start() == 0
+        assert match.end() == 17
+        assert match.tags() == (16, 16)
+        assert match.value() == 2
+
+    def test2(self):
+        match = self.matcher.addFinal('abcd')
+        assert match.start() == 0
+        assert match.end() == 4
+        assert match.tags() == (4,)
+        assert match.value() == 1
+
+    def test3(self):
+        # threads in nested loops which differ only in where they last
+        # entered a loop are merged
+        pat = Trespass.Pattern(r'(a*b)*c', 1)
+        pat.compile('nfa')
+        matcher = Trespass.Matcher(pat)
+        match = matcher.addChunk('a' * 300)
+        assert match is None, repr(match)
+        assert len(matcher.partials) <= 5, matcher.partials
+        match = matcher.addFinal('bc')
+        assert (match.start(), match.end()) == (0, 302), repr(match)
+
+    def test4(self):
+        # merged counting sets keep their threads in order of entry
+        pat = Trespass.Pattern(r'(.{4,}[a-z]{0,5}){2}c', 1)
+        pat.compile('nfa')
+        match = pat.match('xxxxccxabccxc')
+        assert (match.start(), match.end()) == (0, 13), repr(match)
+
+class CharMap1TestCase(unittest.TestCase):
+
+    def test1(self):
+        # a character map shared by two links lists is copied before
+        # it is changed for one of them
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'[^a]q|[^a]d', 1)
+        pat.addRegExp(r'xc', 2)
+        assert pat.match('bc') is None
+        match = pat.match('xc')
+        assert ((match.start(), match.end()), match.value()) == ((0, 2), 2), repr(match)
+        match = pat.match('bd')
+        assert ((match.start(), match.end()), match.value()) == ((0, 2), 1), repr(match)
+
+class First1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(ab)?c+#d', 1)
+        pat.addRegExp(r'x*[[:upper:]]', 2)
+        pat.addRegExp(r'^q', 3)
+        self.pat = pat
+
+    def test1(self):
+        first = self.pat.getFirstCharacters()
+        assert list(first.chars) == ['a', 'c', 'x']
+        assert first.funcs == [Trespass.IsUpper]
+        assert first.find('qqqq', 1) == 4
+        assert first.find('qqx', 0) == 2
+        assert first.find('qq\u00c9', 0) == 2
+
+    def test2(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            matcher = Trespass.Matcher(self.pat)
+            match = matcher.addChunk('zqzzz')
+            assert match is None, repr(match)
+            match = matcher.addChunk('zzzcc')
+            assert match is None, repr(match)
+            match = matcher.addChunk('d')
+            assert match.start() == 8
+            assert match.end() == 11
+            assert match.tags() == (10,)
+            assert match.value() == 1
+
+    def test3(self):
+        # a pattern which can match without a character cannot skip
+        self.pat.addRegExp(r'e?', 4)
+        assert self.pat.getFirstCharacters() is None
+        match = self.pat.match('zz')
+        assert ((match.start(), match.end()), match.value()) == ((0, 0), 4), repr(match)
+
+class Prefilter1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        for i in range(Trespass.PREFILTER_MINIMUM):
+            pat.addRegExp(r'k%dey[0-9]+x' % i, i)
+        pat.addRegExp(r'.{0,3}(color|colour)', 'color')
+        pat.addRegExp(r'ab#c.*def', 'tagged')
+        self.pat = pat
+
+    def test1(self):
+        for regexp, required, offset in [
+            (r'abc', ['abc'], 0),
+            (r'abc.*def', ['abc'], 0),
+            (r'x*abc', ['abc'], None),
+            (r'a(b|c)d', ['abd', 'acd'], 0),
+            (r'colou?r', ['color', 'colour'], 0),
+            (r'(ab){2,}', ['abab'], 0),
+            (r'.{0,5}needle', ['needle'], 5),
+            (r'a|b*', None, None),
+            ]:
+            info = Trespass._literals(Trespass.scan(regexp))
+            if required is not None:
+                assert sorted(info[2]) == required, (regexp, info)
+            else:
+                assert info[2] is None, (regexp, info)
+            assert info[3] == offset, (regexp, info)
+
+    def test2(self):
+        prefilter = self.pat.getPrefilter()
+        assert prefilter.window == 3
+        assert prefilter.enabled('a color k1ey') == {16: 1}
+        assert prefilter.enabled('ab def') == {}
+        assert prefilter.find('zzzzzzzzzz', 0) == 10 - 3 - 6 + 1
+        assert prefilter.find('zzzzzzzzzzk12ey', 0) == 7
+
+    def test3(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            assert self.pat.match('k12ey k3ey3 key5x') is None
+            match = self.pat.match('k12ey k3ey34x abc')
+            assert (match.start(), match.end(), match.value()) == \
+                                                (6, 13, 3), repr(match)
+            match = self.pat.match('k3ey3 ab c defabcx def')
+            assert (match.start(), match.end(), match.tags(),
+                    match.value()) == (14, 22, (16,), 'tagged'), \
+                                                            repr(match)
+
+    def test4(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            matcher = Trespass.Matcher(self.pat)
+            assert matcher.prefilter is self.pat.getPrefilter()
+            match = matcher.addChunk('z' * 50 + 'k11e')
+            assert match is None, repr(match)
+            match = matcher.addChunk('y5x' + 'z' * 10 + 'colo')
+            assert (match.start(), match.end(), match.value()) == \
+                                                (50, 57, 11), repr(match)
+            matcher = Trespass.Matcher(self.pat)
+            match = matcher.addChunk('z' * 50 + 'colo')
+            assert match is None, repr(match)
+            match = matcher.addFinal('ur')
+            assert (match.start(), match.end(), match.value()) == \
+                                            (47, 56, 'color'), repr(match)
+
+class Namespace1TestCase(unittest.TestCase):
+
+    def test1(self):
+        # control nodes return a new namespace, leaving the old one
+        # to be shared by other threads
+        pat = Trespass.Pattern(r'(a{2,}#)+b')
+        pat.compile('nfa')
+        loop = pat.start.getAllLinks()[0]
+        assert isinstance(loop, Trespass.IterationLoopNode)
+        namespace = Trespass._NONAMESPACE
+        links, namespace1 = loop.getMatchedLinks(namespace, 0)
+        assert namespace == ((), None)
+        assert namespace1 == (((loop.slot, 0, 0),), None), namespace1
+        match = pat.match('aaaaaab')
+        assert match.tags() == (6,), match.tags()
+
+    def test2(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat = Trespass.Pattern(r'((a{2}){2,3}#)+b')
+            pat.compile(mode)
+            match = pat.match('aaaaaaaaaaaaab')
+            assert (match.start(), match.end(), match.tags()) == \
+                                        (1, 14, (7, 13)), match.tags()
+
+    def test3(self):
+        # each tag is added without copying those before it
+        for mode in ('nfa', 'lazy'):
+            pat = Trespass.Pattern(r'(x#)*y')
+            pat.compile(mode)
+            match = pat.match('x' * 5000 + 'y')
+            assert match.tags() == tuple(range(1, 5001))
+
+class FindIter1TestCase(unittest.TestCase):
+
+    def test1(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat = Trespass.Pattern()
+            pat.addRegExp(r'[0-9]+', 'number')
+            pat.addRegExp(r'[a-z]+#[0-9]', 'word')
+            pat.compile(mode)
+            result = [(match.start(), match.end(), match.tags(),
+                        match.value())
+                        for match in pat.finditer('ab12 34x cd5', 3)]
+            assert result == [(3, 4, (), 'number'),
+                                (5, 7, (), 'number'),
+                                (9, 12, (11,), 'word')], result
+
+    def test2(self):
+        # an empty match moves the next search on by one character
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat = Trespass.Pattern(r'x*')
+            pat.compile(mode)
+            result = [(match.start(), match.end())
+                                for match in pat.finditer('axbc')]
+            assert result == [(0, 0), (1, 2), (2, 2), (3, 3), (4, 4)], \
+                                                                result
+            assert pat.findall('axbc') == ['', 'x', '', '', '']
+            assert pat.split('axbc') == ['', 'a', '', 'b', 'c', '']
+
+    def test3(self):
+        # ^ only matches at the start of the text
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat = Trespass.Pattern(r'^a|b$')
+            pat.compile(mode)
+            assert pat.findall('aab') == ['a', 'b']
+            assert pat.findall('aab', 1) == ['b']
+
+    def test4(self):
+        pat = Trespass.Pattern(r', *')
+        assert pat.split('a, b,c') == ['a', 'b', 'c']
+        assert pat.split('a, b,c', 1) == ['a', 'b,c']
+        assert pat.split('abc') == ['abc']
+
+class Stream1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'ab+#c', 1)
+        pat.addRegExp(r'x*', 2)
+        self.pat = pat
+
+    def test1(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            matcher = Trespass.StreamMatcher(self.pat)
+            result = []
+            for chunk in ('zab', 'bb', 'cxxa', 'bc', ''):
+                result.append([(match.start(), match.end(), match.tags(),
+                                match.value())
+                                for match in matcher.addChunk(chunk)])
+            result.append([(match.start(), match.end(), match.value())
+                                for match in matcher.addFinal()])
+            assert result == [
+                    [(0, 0, (), 2)],
+                    [],
+                    [(1, 6, (5,), 1), (6, 8, (), 2)],
+                    [(8, 11, (10,), 1)],
+                    [],
+                    [(11, 11, 2)],
+                    ], result
+
+    def test2(self):
+        # only the text from the earliest partial is kept
+        matcher = Trespass.StreamMatcher(self.pat)
+        for i in range(100):
+            matcher.addChunk('zzzzzzzzzz')
+            assert len(matcher.buffer) <= 1, matcher.buffer
+        matcher.addChunk('abbb')
+        assert matcher.buffer == 'zabbb', matcher.buffer
+
+    def test3(self):
+        chunks = ['aa ab', 'c', 'xx']
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            result = [(match.start(), match.end())
+                        for match in self.pat.stream(iter(chunks))]
+            expected = [(match.start(), match.end())
+                        for match in self.pat.finditer(''.join(chunks))]
+            assert result == expected, (result, expected)
+
+class Bytes1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(rb'a[[:digit:]x]+#\x00', 1)
+        pat.addRegExp(rb'[^[:alpha:]\x00]+', 2)
+        self.pat = pat
+
+    def test1(self):
+        text = b'a12\x00--ax\x00\xff'
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            for data in (text, bytearray(text), memoryview(text)):
+                result = [(match.start(), match.end(), match.tags(),
+                            match.value())
+                            for match in self.pat.finditer(data)]
+                assert result == [(0, 4, (3,), 1), (4, 6, (), 2),
+                                  (6, 9, (8,), 1), (9, 10, (), 2)], result
+
+    def test2(self):
+        self.assertRaises(TypeError, self.pat.addRegExp, 'a', 3)
+        pat = Trespass.Pattern()
+        pat.addRegExp('a', 1)
+        self.assertRaises(TypeError, pat.addRegExp, b'a', 2)
+
+    def test3(self):
+        chunks = [bytearray(b'xa1'), memoryview(b'2\x00a'), b'3', b'']
+        result = [(match.start(), match.end(), match.value())
+                    for match in self.pat.stream(iter(chunks))]
+        assert result == [(1, 5, 1), (6, 7, 2)], result
+
+@unittest.skipIf(Trespass.numpy is None, 'numpy is not installed')
+class MatchMany1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'[[:digit:]]+', 'number')
+        pat.addRegExp(r'^[[:alpha:]]+$', 'word')
+        pat.addRegExp(r'x[[:alpha:]]*', 'x')
+        self.pat = pat
+
+    def test1(self):
+        texts = ['abc', 'ab1', '', 'a12b', ' xy 1', '\xe9', 'x\x00']
+        for mode in ('dfa', 'lazy'):
+            self.pat.compile(mode)
+            starts, ends, indexes, values = self.pat.match_many(texts)
+            result = [(starts[i], ends[i], indexes[i])
+                            for i in range(len(texts))]
+            assert result == [(0, 3, 1), (2, 3, 0), (-1, -1, -1),
+                        (1, 3, 0), (1, 3, 2), (0, 1, 1), (0, 1, 2)], result
+            assert list(values) == ['number', 'word', 'x'], values
+
+    def test2(self):
+        # the same as match() for each text
+        texts = ['', 'a', '1', 'xx1', 'x1x', '12ab', 'ab', 'ab ', 'zzx']
+        for mode in ('dfa', 'lazy'):
+            self.pat.compile(mode)
+            starts, ends, indexes, values = self.pat.match_many(texts)
+            for i in range(len(texts)):
+                match = self.pat.match(texts[i])
+                if match is None:
+                    assert starts[i] == ends[i] == indexes[i] == -1
+                else:
+                    assert (starts[i], ends[i], values[indexes[i]]) == (
+                            match.start(), match.end(), match.value())
+
+    def test3(self):
+        pat = Trespass.Pattern(rb'a\x00*b', 1)
+        pat.compile()
+        texts = [b'ab', bytearray(b'ca\x00\x00b'), memoryview(b'\xffab\x00')]
+        starts, ends, indexes, values = pat.match_many(texts)
+        assert list(starts) == [0, 1, 1], starts
+        assert list(ends) == [2, 5, 3], ends
+        assert list(indexes) == [0, 0, 0], indexes
+
+class Parallel1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'ab+#c', 1)
+        pat.addRegExp(r'b*', 2)
+        pat.addRegExp(r'^x|x$', 3)
+        self.pat = pat
+
+    def test1(self):
+        # the same matches as a sequential search, wherever the text
+        # is split
+        text = 'xabbbcbbabcbcab#x'
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            expected = [(match.start(), match.end(), match.tags(),
+                            match.value())
+                            for match in self.pat.finditer(text)]
+            for segment in (1, 2, 5, 100):
+                result = [(match.start(), match.end(), match.tags(),
+                            match.value())
+                            for match in self.pat.search_parallel(
+                                                    text, 2, segment)]
+                assert result == expected, (mode, segment, result)
+
+    def test2(self):
+        pat = Trespass.Pattern(rb'a[^a]*a', 1)
+        self.assertRaises(TypeError, self.pat.search_parallel,
+                                            pathlib.Path('text'))
+        f = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            f.write(b'xxaxxxaxaxxa\x00a')
+            f.close()
+            result = [(match.start(), match.end())
+                        for match in pat.search_parallel(
+                                        pathlib.Path(f.name), 3, 4)]
+        finally:
+            os.unlink(f.name)
+        assert result == [(2, 7), (8, 12)], result
+
+    def test3(self):
+        # a search left unfinished at the end of a segment is followed
+        # only until the worker results apply again
+        pat = Trespass.Pattern(r'a[^!]*z', 1)
+        pat.compile('dfa')
+        pat.trace = Trespass.Trace()
+        segment = 1 << 13
+        text = 'x' * (segment - 5) + 'axx!' + 'x' * (2 * segment) + 'az'
+        result = [(match.start(), match.end())
+                    for match in pat.search_parallel(text, 3, segment)]
+        assert result == [(len(text) - 2, len(text))], result
+        assert pat.trace.chars < segment, pat.trace.getCounters()
+
+class Dump1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(ab+c*)', 1)
+        pat.addRegExp(r'^x[^a-c[:digit:]]{2,3}#y$', 'x')
+        pat.addRegExp(r'[[:alpha:]q]*?z', (3, None))
+        self.pat = pat
+
+    def check(self, pat, texts):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            pat.compile(mode)
+            for text in texts:
+                expected = [(match.start(), match.end(), match.tags(),
+                                match.value())
+                                for match in self.pat.finditer(text)]
+                result = [(match.start(), match.end(), match.tags(),
+                                match.value())
+                                for match in pat.finditer(text)]
+                assert result == expected, (mode, text, result)
+
+    def test1(self):
+        texts = ['abbc xx', 'xqqy', 'x--y', 'QQz abc', '']
+        self.check(Trespass.Pattern.load(self.pat.dump()), texts)
+        self.check(pickle.loads(pickle.dumps(self.pat)), texts)
+
+    def test2(self):
+        # the loaded pattern can have more regexps added
+        pat = Trespass.Pattern.load(self.pat.dump())
+        pat.addRegExp(r'a[^b]', 4)
+        self.pat.addRegExp(r'a[^b]', 4)
+        self.check(pat, ['abbc ax', 'acz', 'xqqy'])
+
+    def test3(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(rb'a[\x00[:digit:]]+', 1)
+        pat = Trespass.Pattern.load(bytearray(pat.dump()))
+        assert pat.findall(b'a\x001a2') == [b'a\x001', b'a2']
+        self.assertRaises(TypeError, pat.addRegExp, 'a', 2)
+
+    def test4(self):
+        data = self.pat.dump()
+        self.assertRaises(ValueError, Trespass.Pattern.load, b'TRSQ')
+        self.assertRaises(ValueError, Trespass.Pattern.load,
+                                    b'XXXX' + data[4:])
+        self.assertRaises(ValueError, Trespass.Pattern.load,
+                                    data[:4] + b'\xff\xff' + data[6:])
+
+class Cache1TestCase(unittest.TestCase):
+
+    def test1(self):
+        cache = Trespass.CompileCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        # 'b' was least recently used
+        assert cache.get('b') is None
+        assert cache.get('a') == 1 and cache.get('c') == 3
+        assert (cache.hits, cache.misses) == (3, 1), (cache.hits,
+                                                        cache.misses)
+        cache.setMaxSize(1)
+        assert len(cache) == 1 and cache.get('c') == 3
+        cache.setMaxSize(0)
+        cache.put('d', 4)
+        assert len(cache) == 0
+
+    def test2(self):
+        regexp = r'ab+#(cd|ef)*gh'
+        tree = Trespass.scan(regexp)
+        assert Trespass.scan(regexp) is tree
+        hits = Trespass.compile_cache.hits
+        pat1 = Trespass.Pattern(regexp, 1)
+        pat2 = Trespass.Pattern()
+        pat2.addRegExp(r'x', 0)
+        pat2.addRegExp(regexp, 2)
+        assert Trespass.compile_cache.hits > hits
+        assert pat1.regexps[0][1] is pat2.regexps[1][1]
+        for pat, value in ((pat1, 1), (pat2, 2)):
+            match = pat.match('zabbefcdgh')
+            assert (match.start(), match.end(), match.tags(),
+                        match.value()) == (1, 10, (4,), value)
+
+    def test3(self):
+        # the shared tree holds no lists which a caller could change
+        def walk(tree):
+            assert not isinstance(tree, list), tree
+            if isinstance(tree, tuple):
+                for part in tree:
+                    walk(part)
+        walk(Trespass.scan(r'a(b|c(d|e|)|f)*(g|h)|i'))
+
+class Remove1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        self.handles = [pat.addRegExp(r'lit%d[a-z]*end' % i, i)
+                            for i in range(20)]
+        self.pat = pat
+
+    def test1(self):
+        pat = self.pat
+        assert pat.match('xlit3abend').value() == 3
+        pat.removeRegExp(self.handles[3])
+        assert pat.match('xlit3abend') is None
+        assert pat.match('xlit13abend').value() == 13
+        self.assertRaises(ValueError, pat.removeRegExp, self.handles[3])
+        handle = pat.addRegExp(r'lit3', 'new')
+        match = pat.match('xlit3abend')
+        assert (match.start(), match.end(), match.value()) == (1, 5, 'new')
+        pat.removeRegExp(handle)
+        assert pat.match('xlit3abend') is None
+
+    def test2(self):
+        # the prefilter is changed, not built again
+        pat = self.pat
+        prefilter = pat.getPrefilter()
+        assert prefilter is not None
+        pat.removeRegExp(self.handles[0])
+        assert pat.getPrefilter() is prefilter
+        # lit4 is already a required literal
+        pat.addRegExp(r'.lit4', 'x')
+        assert pat.getPrefilter() is prefilter
+        assert pat.match('0lit4').value() == 'x'
+        assert pat.match('lit4end').value() == 4
+
+    def test3(self):
+        pat = self.pat
+        matcher = Trespass.Matcher(pat)
+        with pat.batch():
+            for handle in self.handles[:10]:
+                pat.removeRegExp(handle)
+            pat.addRegExp(r'lit1[a-z]', 'b')
+            # the start links are made again at the end
+            assert pat.match('lit1end').end() == 7
+        match = pat.match('lit1end')
+        assert (match.end(), match.value()) == (5, 'b')
+        assert pat.match('lit12end').value() == 12
+        # a Matcher made before keeps the old regexps
+        assert matcher.addFinal('lit1end').value() == 1
+
+class Interval1TestCase(unittest.TestCase):
+
+    def test1(self):
+        # a range is one interval, not a key for each character
+        pat = Trespass.Pattern('[\x00-\uffff]x', 1)
+        (node,) = pat.start.getAllLinks()
+        assert node.starts == ['\x00', '\U00010000']
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat.compile(mode)
+            assert pat.match('\uffffx').end() == 2
+            assert pat.match('\x00x').end() == 2
+            assert pat.match('\U00010000x') is None
+
+    def test2(self):
+        # merged maps keep the links of each regexp at the interval edges
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'[a-m]1', 'am')
+        pat.addRegExp(r'[h-z]2', 'hz')
+        pat.addRegExp(r'[^b-y]3', 'not')
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat.compile(mode)
+            assert pat.match('a1').value() == 'am'
+            assert pat.match('m2').value() == 'hz'
+            assert pat.match('g2') is None
+            assert pat.match('z3').value() == 'not'
+            assert pat.match('\u4e003').value() == 'not'
+            assert pat.match('y3') is None
+
+    def test3(self):
+        charset = Trespass.CharacterSet([('d', 'f'), ('a', 'c'), ('x', 'x')])
+        assert charset.intervals == [('a', 'f'), ('x', 'x')]
+        assert 'e' in charset and 'x' in charset and 'g' not in charset
+        assert len(charset) == 7
+        pat = Trespass.Pattern('[^[:punct:]\u0400-\u04ff]', 1)
+        assert pat.match('\u0416') is None
+        assert pat.match('\u00bf') is None
+        assert pat.match('\u00c0').end() == 1
+        assert pat.match('\u4e00').end() == 1
+
+    def test4(self):
+        # the Latin-1 tables agree with the str predicates
+        printable = lambda ch: not (ord(ch) < 32 or ord(ch) == 127)
+        for ch in '\x00\t a!~\x7f\x85\xa0\xa7\xaa\xdf\xff\u0100\u4e00':
+            assert bool(Trespass.IsAlnum(ch)) == ch.isalnum()
+            assert bool(Trespass.IsSpace(ch)) == ch.isspace()
+            assert bool(Trespass.IsUpper(ch)) == ch.isupper()
+            assert bool(Trespass.IsGraph(ch)) == (printable(ch) and
+                                                    not ch.isspace())
+            assert bool(Trespass.IsPunct(ch)) == (printable(ch) and
+                                    not ch.isalnum() and ch != ' ')
+
+class Alphabet1TestCase(unittest.TestCase):
+
+    def test1(self):
+        pat = Trespass.Pattern('[a-c]x', 1)
+        alphabet = pat.getAlphabet()
+        assert len(alphabet.classes) == 3
+        assert alphabet.getIntervals() == [
+            ('\x00', '`', {(): 0}),
+            ('a', 'c', {(): 1}),
+            ('d', 'w', {(): 0}),
+            ('x', 'x', {(): 2}),
+            ('y', '\U0010ffff', {(): 0}),
+        ]
+        assert alphabet.getClass('b') == 1
+        assert alphabet.getClass('\u4e00') == 0
+
+    def test2(self):
+        # class functions split the characters of an interval
+        pat = Trespass.Pattern()
+        pat.addRegExp('[[:upper:]]1', 1)
+        pat.addRegExp('[^q]2', 2)
+        alphabet = pat.getAlphabet()
+        assert alphabet.getClass('A') == alphabet.getClass('\u0100')
+        assert alphabet.getClass('A') != alphabet.getClass('a')
+        assert alphabet.getClass('q') != alphabet.getClass('a')
+        assert pat.match('\u01002').value() == 2
+        assert pat.match('q2') is None
+
+    def test3(self):
+        # the lazy DFA keeps one transition for each class, not each
+        # character seen
+        pat = Trespass.Pattern('[\u0400-\u04ff]+x', 1)
+        text = ''.join([chr(i) for i in range(0x300, 0x500)]) + 'x'
+        assert pat.match(text).start() == 0x100
+        nclasses = len(pat.getAlphabet().classes)
+        assert nclasses == 3
+        for state in pat.getDFA().states.values():
+            assert len(state.next) <= nclasses
+        assert len(pat.getDFA().initial.next) <= nclasses
+
+    def test4(self):
+        pat = Trespass.Pattern(b'[\x80-\xff]+', 1)
+        alphabet = pat.getAlphabet()
+        assert alphabet.getClass(0x80) == alphabet.getClass(0xff)
+        assert alphabet.getClass(0x7f) != alphabet.getClass(0x80)
+        assert alphabet.getIntervals()[-1] == (0x80, 0xff, {(): 1})
+
+class Earliest1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'ab+c', 1)
+        pat.addRegExp(r'b', 2)
+        pat.addRegExp(r'x#y*z', 3)
+        self.pat = pat
+
+    def test1(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            match = self.pat.search_any('zzabbbc')
+            assert (match.start(), match.end(), match.value()) == (3, 4, 2)
+            match = self.pat.match('zzabbbc')
+            assert (match.start(), match.end(), match.value()) == (2, 7, 1)
+            assert self.pat.search_any('ac') is None
+            match = self.pat.search_any('xyyz b')
+            assert (match.end(), match.value(), match.tags()) == (4, 3, (1,))
+
+    def test2(self):
+        # addChunk returns the match without waiting for later text
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat = Trespass.Pattern(r'ab+', 1)
+            pat.compile(mode)
+            matcher = Trespass.Matcher(pat)
+            assert matcher.addChunk('xab') is None
+            matcher = Trespass.Matcher(pat)
+            matcher.earliest = 1
+            match = matcher.addChunk('xab')
+            assert (match.start(), match.end()) == (1, 3)
+
+class Anchored1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'ab+', 1)
+        pat.addRegExp(r'a+?b*c', 2)
+        self.pat = pat
+
+    def test1(self):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            match = self.pat.prefixmatch('abbbx')
+            assert (match.start(), match.end(), match.value()) == (0, 4, 1)
+            assert self.pat.prefixmatch('xabbb') is None
+            assert self.pat.fullmatch('abbbx') is None
+            match = self.pat.fullmatch('aabbc')
+            assert (match.end(), match.value()) == (5, 2)
+            assert self.pat.fullmatch('') is None
+
+    def test2(self):
+        # no more text is read once no thread from the start is left
+        for mode in ('nfa', 'lazy', 'dfa'):
+            self.pat.compile(mode)
+            matcher = Trespass.Matcher(self.pat)
+            matcher.anchored = 1
+            assert matcher.addFinal('ax' + 'ab' * 100) is None
+            assert matcher.currpos <= 2
+
+class Reverse1TestCase(unittest.TestCase):
+
+    def check(self, pat, texts):
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat.compile(mode)
+            for text in texts:
+                want = pat.match(text)
+                match = pat.search_reverse(text)
+                if want is None:
+                    assert match is None, (text, mode)
+                else:
+                    assert (match.start(), match.end(), match.tags(),
+                                match.value()) == (want.start(), want.end(),
+                                        want.tags(), want.value()), (text, mode)
+
+    def test1(self):
+        # the leftmost match may end after a later one
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'abcde', 1)
+        pat.addRegExp(r'c', 2)
+        pat.addRegExp(r'b+d?', 3)
+        match = pat.search_reverse('xxabcdex')
+        assert (match.start(), match.end(), match.value()) == (2, 7, 1)
+        self.check(pat, ['', 'abcd', 'xbbbdcabcde', 'cabcde', 'xyz'])
+
+    def test2(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'^a#b*#c', 1)
+        pat.addRegExp(r'(ab|c)+?#$', 2)
+        pat.addRegExp(r'x{2,3}(y|z)', 3)
+        self.check(pat, ['abbc', 'xabc', 'cababc', 'xxxxyabc', 'abcx', ''])
+
+    def test3(self):
+        pat = Trespass.Pattern(b'a[b-d]+e?', 1)
+        pat.addRegExp(b'^e|e$', 2)
+        self.check(pat, [b'eabcde', b'xxabx', b'xe', bytearray(b'e')])
+        pat = Trespass.Pattern.load(pat.dump())
+        self.check(pat, [b'eabcde', b'xxabx', b'xe'])
+
+    def test4(self):
+        pat = Trespass.Pattern(r'(a|bc)d*#e', 1)
+        rev = pat.getReverse()
+        match = rev.match('xeddcb')
+        assert (match.start(), match.end(), match.tags()) == (1, 6, ())
+
+class Counting1TestCase(unittest.TestCase):
+
+    def test1(self):
+        pat = Trespass.Pattern(r'[a-z]{5,500}@', 1)
+        pat.addRegExp(r'x{40,}y', 2)
+        assert pat.isCounted()
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat.compile(mode)
+            text = 'ab' * 300 + '@'
+            match = pat.match(text)
+            assert (match.start(), match.end(), match.value()) == (100, 601, 1)
+            assert pat.match('abcd@') is None
+            match = pat.match('x' * 39 + 'y' + 'x' * 40 + 'y')
+            assert (match.start(), match.end(), match.value()) == (40, 81, 2)
+
+    def test2(self):
+        # a counting set holds one partial for all the start positions
+        pat = Trespass.Pattern(r'[a-z]{1,500}[0-9]', 1)
+        pat.compile('nfa')
+        matcher = Trespass.Matcher(pat)
+        assert matcher.addChunk('abc' * 300) is None
+        assert len(matcher.partials) <= 3, matcher.partials
+        match = matcher.addFinal('1')
+        assert (match.start(), match.end()) == (400, 901)
+
+    def test3(self):
+        # the counting sets match the same as the DFAs
+        pat = Trespass.Pattern(r'(a|b[b-c]{1,3}){2,}c{3,7}d?', 1)
+        pat.addRegExp(r'^x.{0,5}$|cb*?', 2)
+        pat.addRegExp(r'[^x]{4}', 3)
+        assert not pat.isCounted()
+        texts = ['', 'abbcaccc', 'xabc', 'xabcdefg', 'bbcbbbcccd', 'cccc']
+        results = []
+        for mode in ('nfa', 'lazy', 'dfa'):
+            pat.compile(mode)
+            results.append([[(m.start(), m.end(), m.value())
+                            for m in pat.finditer(text)] for text in texts])
+        assert results[0] == results[1] == results[2], results
+
+    def test4(self):
+        # tags are kept for each thread
+        pat = Trespass.Pattern(r'a#[a-z]{1,100}#!', 1)
+        assert not pat.isCounted()
+        assert pat.compile('lazy') is not None
+        assert pat.match('aaaa!').tags() == (1, 4)
+
+    def test5(self):
+        # the DFAs are used until the lazy DFA overflows, and then the
+        # graph is walked if there is no BitNFA
+        pat = Trespass.Pattern(r'[a-z]{1,500}[0-9]', 1)
+        pat.addRegExp(r'(a|b)c*d+e+f', 2)
+        assert pat.isCounted()
+        assert isinstance(pat.compile('dfa'), Trespass.FullDFA)
+        self.assertRaises(Trespass.StateLimitExceeded,
+                        pat.compile, 'dfa', 100, 0)
+        dfa = pat.compile('lazy', 100)
+        match = pat.match('abc' * 300 + '1')
+        assert (match.start(), match.end()) == (400, 901)
+        assert dfa.flushes > 0
+        assert pat.getDFA() is None
+        match = pat.match('xacdef')
+        assert (match.start(), match.end(), match.value()) == (1, 6, 2)
+
+class Bits1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(ab+c*)', 1)
+        pat.addRegExp(r'bf(ab+)*', 2)
+        pat.addRegExp(r'^(a(bc)?)*$', 3)
+        pat.addRegExp(r'01x?(ab+)*2', 'red')
+        self.pat = pat
+
+    def test1(self):
+        bits = self.pat.compile('bits')
+        assert isinstance(bits, Trespass.BitNFA)
+        assert bits.npositions <= Trespass.BITS_MAX_POSITIONS
+        match = self.pat.match('ddg01abb2s')
+        assert ((match.start(), match.end()), match.value()) == ((3, 9), 'red'), repr(match)
+        match = self.pat.match('abcabc')
+        assert ((match.start(), match.end()), match.value()) == ((0, 6), 3), repr(match)
+        matcher = Trespass.Matcher(self.pat)
+        assert matcher.addChunk('ab') is None
+        assert matcher.addChunk('bcc') is None
+        match = matcher.addChunk('z')
+        assert ((match.start(), match.end()), match.value()) == ((0, 5), 1), repr(match)
+
+    def test2(self):
+        # tagged patterns, and those with too many positions, fall back
+        # to the lazy DFA
+        pat = Trespass.Pattern(r'a+#a+?', 7)
+        assert isinstance(pat.compile('bits'), Trespass.LazyDFA)
+        pat = Trespass.Pattern(r'[ab]{30}x[ab]{30}y[ab]{10}', 1)
+        assert isinstance(pat.compile('bits'), Trespass.LazyDFA)
+        self.assertRaises(Trespass.StateLimitExceeded,
+                        pat.compile, 'bits', None, 0)
+
+    def test3(self):
+        # a lazy DFA whose cache overflows switches to the BitNFA
+        # part way through the text
+        pat = Trespass.Pattern(r'[ab]*a[ab]{20}c', 1)
+        text = ''.join(['ab'[bin(i).count('1') & 1] for i in range(2000)])
+        text += 'a' + 'b' * 20 + 'c'
+        dfa = pat.compile('lazy', 100)
+        matcher = Trespass.Matcher(pat)
+        match = matcher.addFinal(text)
+        assert dfa.flushes > 0
+        assert isinstance(matcher.dfa, Trespass.BitNFA)
+        assert isinstance(pat.getDFA(), Trespass.BitNFA)
+        assert ((match.start(), match.end()), match.value()) == ((0, 2022), 1), repr(match)
+
+    def test4(self):
+        # the BitNFA matches the same as the DFAs
+        pat = Trespass.Pattern(r'(a|b[b-c]{1,3}){2,}c{3,7}d?', 1)
+        pat.addRegExp(r'^x.{0,5}$|cb*?', 2)
+        pat.addRegExp(r'[^x]{4}', 3)
+        texts = ['', 'abbcaccc', 'xabc', 'xabcdefg', 'bbcbbbcccd', 'cccc']
+        results = []
+        for mode in ('nfa', 'bits', 'dfa'):
+            pat.compile(mode)
+            results.append([[(m.start(), m.end(), m.value())
+                            for m in pat.finditer(text)] for text in texts])
+            results.append([(m.start(), m.end(), m.value()) for text in texts
+                            for m in [pat.search_any(text)] if m])
+        assert results[0::2] == [results[0]] * 3, results
+        assert results[1::2] == [results[1]] * 3, results
+
+class Closure1TestCase(unittest.TestCase):
+
+    def test1(self):
+        # the closures skip option, tag and loop exit nodes
+        pat = Trespass.Pattern(r'(a#b?)*c', 1)
+        closures = pat.getClosures()
+        for node, nodes in closures.items():
+            for leaf, pops, ntags in nodes:
+                assert not isinstance(leaf, (Trespass.OptionalNode,
+                                Trespass.TagControlNode,
+                                Trespass.IterationExitNode)), leaf
+        nodes = [leaf for leaf, pops, ntags in closures[pat.start]]
+        assert len(nodes) == 1
+        assert isinstance(nodes[0], Trespass.IterationLoopNode)
+        assert pat.getClosures() is closures
+        pat.addRegExp(r'd', 2)
+        assert pat.getClosures() is not closures
+
+    def test2(self):
+        # tags and counters are changed as the skipped nodes would
+        pat = Trespass.Pattern(r'(a#b?){2,3}#c?', 1)
+        for mode in ('nfa', 'lazy'):
+            pat.compile(mode)
+            match = pat.match('xaabab')
+            assert (match.start(), match.end()) == (1, 6), repr(match)
+            assert match.tags() == (2, 3, 5, 6), match.tags()
+            match = pat.match('abac')
+            assert (match.start(), match.end()) == (0, 4), repr(match)
+            assert match.tags() == (1, 3, 3), match.tags()
+
+class Codegen1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'(ab+c*)', 1)
+        pat.addRegExp(r'bf(ab+)*', 2)
+        pat.addRegExp(r'^(a(bc)?)*$', 3)
+        pat.addRegExp(r'01x?(ab+)*2|[[:digit:]]{3}', 'red')
+        self.pat = pat
+
+    def test1(self):
+        # the generated function matches the same as match
+        match = self.pat.compile_codegen()
+        assert self.pat.compile_codegen() is match
+        for text in ['', 'abbbabf', 'ddg01abb2s', 'abcabc',
+                        'x\u0663\u0663\u0663', 'bfabab', 'zzz']:
+            want = self.pat.match(text)
+            got = match(text)
+            if want is None:
+                assert got is None, (text, got)
+            else:
+                assert (got.start(), got.end(), got.value()) == \
+                        (want.start(), want.end(), want.value()), text
+        self.pat.addRegExp(r'zz', 4)
+        assert self.pat.compile_codegen() is not match
+        assert self.pat.compile_codegen()('zzz').value() == 4
+
+    def test2(self):
+        # the source can be saved as a module
+        pat = Trespass.Pattern(rb'a[^a]*a', 'x')
+        pat.addRegExp(rb'\x00+', 'nul')
+        source = pat.to_python('find')
+        d = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(d, 'generated.py'), 'w') as f:
+                f.write(source)
+            sys.path.insert(0, d)
+            try:
+                import generated
+            finally:
+                sys.path.remove(d)
+                sys.modules.pop('generated', None)
+        finally:
+            os.unlink(os.path.join(d, 'generated.py'))
+            os.rmdir(d)
+        assert generated.find(b'xxaxxxaxa') == (2, 7, 0)
+        assert generated.find(bytearray(b'x\x00\x00a')) == (1, 3, 1)
+        assert generated.find(b'xxa') is None
+
+    def test3(self):
+        # tagged patterns have no full DFA
+        pat = Trespass.Pattern(r'a+#a+?', 7)
+        self.assertRaises(Trespass.StateLimitExceeded, pat.to_python)
+
+class Trace1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        pat = Trespass.Pattern()
+        pat.addRegExp(r'ab|b+', 1)
+        pat.addRegExp(r'(c#d?)*e', 2)
+        self.pat = pat
+
+    def test1(self):
+        # the counters are the same for every engine, except the work
+        # of walking the graph
+        for mode in ('nfa', 'lazy', 'dfa', 'bits'):
+            self.pat.compile(mode)
+            trace = self.pat.trace = Trespass.Trace()
+            match = self.pat.match('xabbbb')
+            assert (match.start(), match.end()) == (1, 3), repr(match)
+            counters = trace.getCounters()
+            walked = counters.pop('expansions'), counters.pop('copies')
+            assert counters == {'chars': 4, 'peak': 3, 'matches': 1,
+                                'pruned': 2}, (mode, counters)
+            if mode == 'nfa':
+                assert walked[0] > 0, walked
+            else:
+                assert walked == (0, 0), walked
+        trace.reset()
+        assert trace.getCounters()['chars'] == 0
+
+    def test2(self):
+        # the callback is given a record of each event
+        self.pat.compile('nfa')
+        events = []
+        self.pat.trace = Trespass.Trace(events.append)
+        match = self.pat.match('cdcde')
+        assert (match.start(), match.end()) == (0, 5), repr(match)
+        assert match.tags() == (1, 3), match.tags()
+        chars = [event for event in events
+                    if isinstance(event, Trespass.CharEvent)]
+        assert [(event.pos, event.ch) for event in chars] == \
+                [(0, 'c'), (1, 'd'), (2, 'c'), (3, 'd'), (4, 'e')], chars
+        matches = [event for event in events
+                    if isinstance(event, Trespass.MatchEvent)]
+        assert matches == [Trespass.MatchEvent(0, 5, 2, True)], matches
+        assert self.pat.trace.copies > 0
+
+    def test3(self):
+        # a Matcher has no Trace unless given one
+        matcher = Trespass.Matcher(self.pat)
+        assert matcher.trace is None
+        match = matcher.addFinal('xab')
+        assert (match.start(), match.end()) == (1, 3), repr(match)
+        trace = Trespass.Trace()
+        matcher.reset()
+        matcher.trace = trace
+        matcher.addChunk('xa')
+        matcher.addFinal('b')
+        assert trace.chars == 3, trace.getCounters()
+
 
 def suite():
     suite = unittest.makeSuite(RE0TestCase, '')